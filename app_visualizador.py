@@ -1,34 +1,22 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
 import pandas as pd
+import numpy as np
 import os
-import threading
-import sys
-from io import StringIO
-import importlib.util
-
-# Tenta importar o script de geração como módulo
-# Isso permite rodar a função diretamente se preferir, ou usar subprocess.
-# Vamos usar execução direta da função para simplificar a integração, 
-# mas redirecionando stdout para capturar logs.
-
-def get_script_module(script_path):
-    spec = importlib.util.spec_from_file_location("generate_final_export_v3", script_path)
-    module = importlib.util.module_from_spec(spec)
-    sys.modules["generate_final_export_v3"] = module
-    spec.loader.exec_module(module)
-    return module
-
-class RedirectText:
-    def __init__(self, text_ctrl):
-        self.output = text_ctrl
-
-    def write(self, string):
-        self.output.insert(tk.END, string)
-        self.output.see(tk.END)
-
-    def flush(self):
-        pass
+from collections import deque
+from web_app.services import result_store
+from web_app.services.text_search import NgramIndex
+from recalc_job import RecalcJob
+
+# O cálculo roda em outro processo (recalc_job); logs e progresso chegam por
+# uma fila lida periodicamente pelo loop do Tk.
+POLL_MS = 100
+
+# Espera após a última tecla antes de filtrar
+FILTER_DELAY_MS = 250
+
+# Linhas inseridas de cada vez na lista PO (na carga e ao rolar até o fim)
+PO_FILL_ROWS = 200
 
 class OrcamentoApp:
     def __init__(self, root):
@@ -39,17 +27,31 @@ class OrcamentoApp:
         # Variáveis de dados
         self.df_servicos = None
         self.df_insumos = None
+        self.ins_index = {} # parent_code -> posições em df_insumos
+        self.ins_rows_cache = {} # parent_code -> (linhas formatadas, total formatado)
+        self.search_index = {} # coluna -> NgramIndex (busca da barra de filtros)
+        self.filter_job = None # after() pendente do filtro
+        self.job = None # RecalcJob em andamento
+        self.po_to_open = deque() # grupos a abrir quando chegarem à tela, na ordem da lista
+        self.po_fill_job = None # after_idle pendente do preenchimento da lista
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
         # --- Layout Principal ---
         # Top Bar (Botoes)
         frame_top = ttk.Frame(root, padding=10)
         frame_top.pack(fill=tk.X)
 
-        btn_recalc = ttk.Button(frame_top, text="Recalcular Completo (Gerar CSVs)", command=self.start_recalc)
-        btn_recalc.pack(side=tk.LEFT, padx=5)
+        self.btn_recalc = ttk.Button(frame_top, text="Recalcular Completo (Gerar CSVs)", command=self.start_recalc)
+        self.btn_recalc.pack(side=tk.LEFT, padx=5)
+
+        self.btn_cancel = ttk.Button(frame_top, text="Cancelar", command=self.cancel_recalc, state=tk.DISABLED)
+        self.btn_cancel.pack(side=tk.LEFT, padx=5)
 
-        btn_load = ttk.Button(frame_top, text="Carregar Dados Existentes", command=self.load_data)
-        btn_load.pack(side=tk.LEFT, padx=5)
+        self.btn_load = ttk.Button(frame_top, text="Carregar Dados Existentes", command=self.load_data)
+        self.btn_load.pack(side=tk.LEFT, padx=5)
+
+        self.progress = ttk.Progressbar(frame_top, mode="determinate", length=200)
+        self.progress.pack(side=tk.LEFT, padx=10)
 
         self.lbl_status = ttk.Label(frame_top, text="Aguardando ação...", foreground="blue")
         self.lbl_status.pack(side=tk.LEFT, padx=20)
@@ -90,9 +92,10 @@ class OrcamentoApp:
         self.filters['source'].bind("<KeyRelease>", self.apply_advanced_filter)
 
         cols_po = ("idx", "source", "code", "desc", "unit", "qty", "price_unit", "price_total")
-        self.tree_po = ttk.Treeview(frame_left, columns=cols_po, show="headings", selectmode="browse")
+        self.tree_po = ttk.Treeview(frame_left, columns=cols_po, show="tree headings", selectmode="browse")
         
-        # Configurar colunas PO
+        # Configurar colunas PO (#0 = coluna da árvore: seta de expandir e recuo dos níveis)
+        self.tree_po.column("#0", width=70, stretch=False)
         self.tree_po.heading("idx", text="Item")
         self.tree_po.column("idx", width=50, anchor="center")
         self.tree_po.heading("source", text="Fonte")
@@ -115,11 +118,11 @@ class OrcamentoApp:
         self.tree_po.tag_configure('warning_source', foreground='#e67e22') # Fonte desconhecida/estranha
         self.tree_po.tag_configure('ok', foreground='black')
 
-        scroll_po = ttk.Scrollbar(frame_left, orient="vertical", command=self.tree_po.yview)
-        self.tree_po.configure(yscrollcommand=scroll_po.set)
+        self.scroll_po = ttk.Scrollbar(frame_left, orient="vertical", command=self.tree_po.yview)
+        self.tree_po.configure(yscrollcommand=self.on_po_scroll)
         
         self.tree_po.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        scroll_po.pack(side=tk.RIGHT, fill=tk.Y)
+        self.scroll_po.pack(side=tk.RIGHT, fill=tk.Y)
 
         # --- Legenda de Cores ---
         frame_legend = ttk.Frame(frame_left)
@@ -143,6 +146,7 @@ class OrcamentoApp:
         add_legend_item(frame_legend, "■ Erro/Zerado", "red")
 
         self.tree_po.bind("<<TreeviewSelect>>", self.on_item_select)
+        self.tree_po.bind("<<TreeviewOpen>>", self.on_po_open)
 
         # --- Lado Direito: Detalhes da Composição ---
         frame_right = ttk.Labelframe(paned, text="Detalhes da Composição (Insumos/Filhos)", padding=5)
@@ -192,43 +196,63 @@ class OrcamentoApp:
         self.txt_log.see(tk.END)
 
     def start_recalc(self):
+        # Evita dois cálculos ao mesmo tempo (duplo clique, etc.)
+        if self.job is not None and self.job.is_running():
+            return
+        if not os.path.exists("generate_final_export_v3.py"):
+            self.log("ERRO: Arquivo 'generate_final_export_v3.py' não encontrado.")
+            self.finish_recalc(success=False)
+            return
+
         self.lbl_status.config(text="Calculando... Verifique os logs abaixo.")
         self.btn_recalc_state(tk.DISABLED)
-        
-        # Thread para não travar a GUI
-        t = threading.Thread(target=self.run_calculation_script)
-        t.start()
+        self.progress.config(value=0, maximum=1)
+        self.log("--- INICIANDO CÁLCULO ---")
+
+        self.job = RecalcJob("generate_final_export_v3.py")
+        self.job.start()
+        self.root.after(POLL_MS, self.poll_recalc)
+
+    def cancel_recalc(self):
+        if self.job is not None and self.job.is_running():
+            self.log("Cancelando...")
+            self.job.cancel()
+
+    def on_close(self):
+        # O processo de cálculo não é daemon (tem seu próprio pool): encerra antes de sair
+        if self.job is not None and self.job.is_running():
+            self.job.cancel()
+        self.root.destroy()
 
     def btn_recalc_state(self, state):
         # Helper para habilitar/desabilitar botões durante processamento
-        pass 
-
-    def run_calculation_script(self):
-        # Redirecionar stdout para a caixa de texto
-        old_stdout = sys.stdout
-        sys.stdout = RedirectText(self.txt_log)
-        
-        try:
-            print("--- INICIANDO CÁLCULO ---")
-            # Importa dinamicamente o script existente
-            if os.path.exists("generate_final_export_v3.py"):
-                mod = get_script_module("generate_final_export_v3.py")
-                mod.run_final_export_v3()
-                print("--- CÁLCULO CONCLUÍDO COM SUCESSO ---")
-                
-                # Agenda o recarregamento dos dados na thread principal
-                self.root.after(100, lambda: self.finish_recalc(success=True))
-            else:
-                print("ERRO: Arquivo 'generate_final_export_v3.py' não encontrado.")
-                self.root.after(100, lambda: self.finish_recalc(success=False))
-                
-        except Exception as e:
-            print(f"ERRO CRÍTICO: {e}")
-            import traceback
-            traceback.print_exc()
-            self.root.after(100, lambda: self.finish_recalc(success=False))
-        finally:
-            sys.stdout = old_stdout
+        self.btn_recalc.config(state=state)
+        self.btn_load.config(state=state)
+        self.btn_cancel.config(state=tk.NORMAL if state == tk.DISABLED else tk.DISABLED)
+
+    def poll_recalc(self):
+        # Roda na thread do Tk: consome os eventos do processo de cálculo
+        for ev in self.job.poll():
+            if ev['type'] == 'log':
+                self.log(ev['text'])
+            elif ev['type'] == 'progress':
+                self.progress.config(maximum=ev['steps'], value=ev['step'])
+                self.lbl_status.config(
+                    text=f"Calculando... {ev['stage']} ({ev['step']}/{ev['steps']}, {ev['rows']} linhas, {ev['elapsed']:.0f}s)")
+            elif ev['type'] == 'done':
+                if ev['ok']:
+                    self.log(f"--- CÁLCULO CONCLUÍDO COM SUCESSO ({ev['elapsed']:.0f}s) ---")
+                    self.finish_recalc(success=True)
+                elif ev['cancelled']:
+                    self.log("--- CÁLCULO CANCELADO ---")
+                    self.btn_recalc_state(tk.NORMAL)
+                    self.progress.config(value=0)
+                    self.lbl_status.config(text="Cálculo cancelado.")
+                else:
+                    self.log(f"ERRO CRÍTICO: {ev['error']}")
+                    self.finish_recalc(success=False)
+                return
+        self.root.after(POLL_MS, self.poll_recalc)
 
     def finish_recalc(self, success):
         self.btn_recalc_state(tk.NORMAL)
@@ -243,17 +267,28 @@ class OrcamentoApp:
         f_serv = "tabela_servicos_export.csv"
         f_ins = "tabela_insumos_export.csv"
 
-        if not os.path.exists(f_serv) or not os.path.exists(f_ins):
+        # Preferir o banco de resultados (dados/resultados.sqlite); os CSVs continuam como alternativa
+        use_store = result_store.exists()
+        if not use_store and (not os.path.exists(f_serv) or not os.path.exists(f_ins)):
             if not silent:
                 messagebox.showwarning("Aviso", "Arquivos de dados não encontrados. Clique em 'Recalcular Completo'.")
             return
 
         try:
-            self.df_servicos = pd.read_csv(f_serv)
-            self.df_insumos = pd.read_csv(f_ins)
+            if use_store:
+                self.df_servicos = result_store.load_servicos()
+                self.df_insumos = result_store.load_insumos()
+            else:
+                self.df_servicos = pd.read_csv(f_serv)
+                self.df_insumos = pd.read_csv(f_ins)
+            # Índice parent_code -> linhas, montado uma vez por carga (sem consulta nem filtro a cada clique)
+            self.df_insumos = self.df_insumos.reset_index(drop=True)
+            self.ins_index = self.df_insumos.groupby(self.df_insumos['parent_code'].astype(str), sort=False).indices
+            self.ins_rows_cache = {}
             
             # Limpar e popular Treeview PO
             self.populate_po_tree(self.df_servicos)
+            self.build_search_index(self.df_servicos)
             
             self.lbl_status.config(text="Dados carregados com sucesso.")
             if not silent:
@@ -265,8 +300,7 @@ class OrcamentoApp:
                 messagebox.showerror("Erro de Leitura", str(e))
 
     def populate_po_tree(self, df):
-        for i in self.tree_po.get_children():
-            self.tree_po.delete(i)
+        self.tree_po.delete(*self.tree_po.get_children())
             
         if df is None: return
 
@@ -277,130 +311,205 @@ class OrcamentoApp:
         self.tree_po.tag_configure('error', foreground='red')
         self.tree_po.tag_configure('ok', foreground='black')
 
-        # Map idx -> tree_item_id
-        self.idx_to_id = {}
-        
         # Sort by idx logic
         try:
             # Create temporary sort key
             df = df.copy()
+            df['row'] = np.arange(len(df))
             df['sort_key'] = df['idx'].apply(lambda x: [int(part) for part in str(x).split('.') if part.isdigit()] if pd.notnull(x) else [])
             df = df.sort_values('sort_key')
         except:
             pass 
-
-        for _, row in df.iterrows():
-            idx = str(row['idx']).strip()
-            
-            # Find parent
+        self.po_order = df['row'].to_numpy() if 'row' in df else np.arange(len(df)) # posição na árvore -> linha do df
+
+        # Prepare values column-wise (the tree itself is filled lazily, see expand_po_node)
+        def text_col(name):
+            return df[name].astype(object).where(df[name].notna(), "").astype(str) if name in df else pd.Series("", index=df.index)
+
+        idx_col = df['idx'].astype(str).str.strip()
+        source_col = text_col('source')
+        code_col = text_col('code')
+        desc_col = text_col('desc')
+        unit_col = text_col('unit')
+        status_col = text_col('status')
+        qty_col = pd.to_numeric(df['qty'], errors='coerce').fillna(0.0) if 'qty' in df else pd.Series(0.0, index=df.index)
+        price_col = pd.to_numeric(df['final_price'], errors='coerce').fillna(0.0) if 'final_price' in df else pd.Series(0.0, index=df.index)
+        is_header = status_col == 'HEADER'
+        total_col = price_col * qty_col
+
+        # Group totals: one groupby over the idx prefixes of the items (numeric, not parsed back from the widget)
+        totals = result_store.group_totals(pd.DataFrame({
+            'idx': idx_col, 'type': np.where(is_header, 'HEADER', 'ITEM'), 'qty': qty_col, 'final_price': price_col}))
+        group_total = dict(zip(totals['idx'], totals['total']))
+
+        # Tags
+        tag_col = np.select(
+            [is_header, status_col == 'PARTIAL', status_col == 'NO_COMP', (status_col == 'ERROR') | (price_col == 0)],
+            ['header', 'partial', 'no_comp', 'error'], default='ok')
+
+        self.po_rows = []
+        self.po_tags = []
+        self.po_children = {-1: []} # posição do pai (-1 = raiz) -> posições dos filhos, na ordem do idx
+        pos_of = {}
+        for pos, (idx, source, code, desc, unit, qty_val, price_val, total_val, header, tag) in enumerate(zip(
+                idx_col, source_col, code_col, desc_col, unit_col, qty_col, price_col, total_col, is_header, tag_col)):
+            # Find parent (e.g. 1.1.1 -> 1.1); without it the row goes to the root
             parts = idx.split('.')
-            parent_id = ""
-            # Try to find parent by progressively removing last segment
-            # e.g. 1.1.1 -> try 1.1 -> try 1
-            if len(parts) > 1:
-                parent_idx = ".".join(parts[:-1])
-                if parent_idx in self.idx_to_id:
-                    parent_id = self.idx_to_id[parent_idx]
-            
-            # Prepare values
-            code = str(row['code']) if pd.notnull(row['code']) else ""
-            desc = str(row['desc']) if pd.notnull(row['desc']) else ""
-            unit = str(row['unit']) if pd.notnull(row['unit']) else ""
-            status = str(row['status']) if pd.notnull(row['status']) else ""
-            
-            # Qty
-            qty_val = 0.0
-            if 'qty' in row and pd.notnull(row['qty']):
-                try: qty_val = float(row['qty'])
-                except: pass
-            
-            # Price
-            price_val = 0.0
-            if 'final_price' in row and pd.notnull(row['final_price']):
-                price_val = float(row['final_price'])
-            
-            # If item is ITEM type, use final_price. If HEADER, we will sum later (initially 0 or -)
-            p_unit_str = f"R$ {price_val:,.2f}" if status != 'HEADER' else ""
-            
-            # Calculate Total for Items
-            total_val = 0.0
-            p_total_str = ""
-            if status != 'HEADER':
-                total_val = price_val * qty_val
+            parent = pos_of.get(".".join(parts[:-1]), -1) if len(parts) > 1 else -1
+            self.po_children.setdefault(parent, []).append(pos)
+            pos_of[idx] = pos
+
+            # If item is ITEM type, use final_price. If HEADER, the sum of its items
+            p_unit_str = f"R$ {price_val:,.2f}" if not header else ""
+            if not header:
                 p_total_str = f"R$ {total_val:,.2f}"
+            else:
+                p_total_str = f"R$ {group_total[idx]:,.2f}" if idx in group_total else ""
+
+            self.po_rows.append((idx, source, code, desc, unit, f"{qty_val:,.2f}", p_unit_str, p_total_str))
+            self.po_tags.append((str(tag),))
+
+        self.po_parent = {c: p for p, cs in self.po_children.items() for c in cs}
+        self.po_expanded = set()
+        self.po_visible = None # None = sem filtro; senão o conjunto de posições visíveis
+        self.expand_po_node(-1)
+        # A lista abre como antes (todos os grupos abertos), mas só o início é inserido agora;
+        # o resto entra quando a rolagem chega ao fim do que já foi inserido
+        self.po_to_open = deque(c for c in self.po_children[-1] if c in self.po_children)
+        self.fill_po_tree()
+
+    def po_iid(self, pos):
+        return "" if pos == -1 else f"r{pos}"
+
+    def expand_po_node(self, pos):
+        # Insere os filhos de um nó só quando ele é aberto (o placeholder mostra a seta de expandir)
+        if pos in self.po_expanded:
+            return
+        self.po_expanded.add(pos)
+        parent_iid = self.po_iid(pos)
+        if pos != -1 and self.tree_po.exists(f"p{pos}"):
+            self.tree_po.delete(f"p{pos}")
+        for child in self.po_children.get(pos, ()):
+            iid = self.tree_po.insert(parent_iid, tk.END, iid=self.po_iid(child), values=self.po_rows[child], tags=self.po_tags[child])
+            if child in self.po_children:
+                self.sync_po_placeholder(child)
+            if self.po_visible is not None and child not in self.po_visible:
+                self.tree_po.detach(iid)
+
+    def sync_po_placeholder(self, pos):
+        # Placeholder só enquanto o nó não foi aberto e tem filhos visíveis (senão a seta abriria um nó vazio)
+        if pos in self.po_expanded:
+            return
+        ph = f"p{pos}"
+        if not self.tree_po.exists(ph):
+            self.tree_po.insert(self.po_iid(pos), tk.END, iid=ph)
+        if self.po_visible is None or any(c in self.po_visible for c in self.po_children[pos]):
+            self.tree_po.move(ph, self.po_iid(pos), 0)
+        else:
+            self.tree_po.detach(ph)
+
+    def fill_po_tree(self):
+        # Abre os próximos grupos, na ordem da lista, até inserir PO_FILL_ROWS linhas
+        self.po_fill_job = None
+        inserted = 0
+        while self.po_to_open and inserted < PO_FILL_ROWS:
+            pos = self.po_to_open.popleft()
+            if pos not in self.po_expanded:
+                self.expand_po_node(pos)
+                self.tree_po.item(self.po_iid(pos), open=True)
+                inserted += len(self.po_children[pos])
+            self.po_to_open.extendleft(reversed([c for c in self.po_children[pos] if c in self.po_children]))
+
+    def on_po_scroll(self, first, last):
+        self.scroll_po.set(first, last)
+        # Fim do que já foi inserido à vista: insere os próximos grupos (fora do callback do Tk)
+        if float(last) > 0.9 and self.po_to_open and self.po_fill_job is None:
+            self.po_fill_job = self.root.after_idle(self.fill_po_tree)
+
+    def on_po_open(self, event):
+        iid = self.tree_po.focus()
+        if iid.startswith("r"):
+            self.expand_po_node(int(iid[1:]))
+
+    def filter_po_tree(self, visible):
+        # Mostra/esconde nós já existentes (detach/move) em vez de reconstruir a árvore
+        if visible is not None:
+            # Ancestors of every match stay visible, opened down to the match
+            for pos in list(visible):
+                parent = self.po_parent.get(pos, -1)
+                while parent != -1 and parent not in visible:
+                    visible.add(parent)
+                    parent = self.po_parent.get(parent, -1)
+            for pos in sorted(visible):
+                parent = self.po_parent.get(pos, -1)
+                chain = []
+                while parent != -1:
+                    chain.append(parent)
+                    parent = self.po_parent.get(parent, -1)
+                for p in reversed(chain):
+                    self.expand_po_node(p)
+                    self.tree_po.item(self.po_iid(p), open=True)
+        self.po_visible = visible
+
+        for parent in sorted(self.po_expanded):
+            parent_iid = self.po_iid(parent)
+            k = 0
+            for child in self.po_children.get(parent, ()):
+                iid = self.po_iid(child)
+                if visible is None or child in visible:
+                    self.tree_po.move(iid, parent_iid, k)
+                    k += 1
+                else:
+                    self.tree_po.detach(iid)
+                if child in self.po_children:
+                    self.sync_po_placeholder(child)
+
+    def build_search_index(self, df):
+        # Colunas já normalizadas (maiúsculas, sem acento) com índice de trigramas, uma vez por carga
+        self.search_index = {
+            col: NgramIndex(df[col].astype(object).where(df[col].notna(), "") if col in df else [""] * len(df))
+            for col in ('code', 'desc', 'source')
+        }
+        # linha do df -> posição na árvore
+        self.po_pos_of_row = np.empty(len(self.po_order), dtype=np.int64)
+        self.po_pos_of_row[self.po_order] = np.arange(len(self.po_order))
 
-            # Tags
-            tags = []
-            if status == 'HEADER': tags.append('header')
-            elif status == 'PARTIAL': tags.append('partial')
-            elif status == 'NO_COMP': tags.append('no_comp')
-            elif status == 'ERROR' or price_val == 0: tags.append('error')
-            else: tags.append('ok')
-            
-            # Insert (Open by default to show structure)
-            vals = (idx, row['source'], code, desc, unit, f"{qty_val:,.2f}", p_unit_str, p_total_str)
-            iid = self.tree_po.insert(parent_id, tk.END, values=vals, tags=tuple(tags), open=True)
-            self.idx_to_id[idx] = iid
-
-        # Calculate Group Totals
-        self.calculate_group_totals()
-
-    def calculate_group_totals(self):
-        # Recursive calculation
-        def calc_node(item_id):
-            children = self.tree_po.get_children(item_id)
-            vals = list(self.tree_po.item(item_id)['values'])
-            
-            # If it's a leaf/item, return its TOTAL price (from col 7)
-            # Col 7 is 'price_total'
-            # Note: treeview values are strings if we inserted strings.
-            # Index: 0=idx, 1=src, 2=code, 3=desc, 4=unit, 5=qty, 6=price_unit, 7=price_total
-            
-            current_total = 0.0
-            
-            if not children:
-                # Leaf Item
-                try:
-                    t_str = vals[7] 
-                    if t_str:
-                        current_total = float(t_str.replace('R$ ','').replace('.','').replace(',','.'))
-                except:
-                    pass
-                return current_total
-
-            # If it has children, it's a group. Sum children.
-            total = 0.0
-            for child in children:
-                total += calc_node(child)
-            
-            # Update this node's Total column (Col 7)
-            vals[7] = f"R$ {total:,.2f}"
-            self.tree_po.item(item_id, values=vals)
-            return total
+    def apply_advanced_filter(self, event):
+        # Debounce: só filtra quando a digitação para por FILTER_DELAY_MS
+        if self.filter_job is not None:
+            self.root.after_cancel(self.filter_job)
+        self.filter_job = self.root.after(FILTER_DELAY_MS, self.run_filter)
 
-        for child in self.tree_po.get_children(""):
-            calc_node(child)
+    def run_filter(self):
+        self.filter_job = None
+        if self.df_servicos is None: return
 
+        rows = None
+        for col, entry in self.filters.items():
+            text = entry.get().strip()
+            if text:
+                found = self.search_index[col].search(text)
+                rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
 
-    def apply_advanced_filter(self, event):
-        if self.df_servicos is None: return
-        
-        f_code = self.filters['code'].get().lower()
-        f_desc = self.filters['desc'].get().lower()
-        f_src = self.filters['source'].get().lower()
-        
-        # Inicia com todos
-        mask = pd.Series([True] * len(self.df_servicos))
-        
-        if f_code:
-            mask = mask & self.df_servicos['code'].astype(str).str.lower().str.contains(f_code)
-        if f_desc:
-            mask = mask & self.df_servicos['desc'].astype(str).lower().str.contains(f_desc)
-        if f_src:
-            mask = mask & self.df_servicos['source'].astype(str).str.lower().str.contains(f_src)
-            
-        filtered_df = self.df_servicos[mask]
-        self.populate_po_tree(filtered_df)
+        if rows is None:
+            self.filter_po_tree(None)
+        else:
+            self.filter_po_tree(set(self.po_pos_of_row[rows].tolist()))
+
+    def composition_rows(self, code):
+        # Linhas já formatadas da composição (cache por código)
+        if code not in self.ins_rows_cache:
+            df = self.df_insumos.iloc[self.ins_index.get(code, [])]
+            coef = pd.to_numeric(df['coef'], errors='coerce').fillna(0.0).to_numpy()
+            price = pd.to_numeric(df['price'], errors='coerce').fillna(0.0).to_numpy()
+            subtotal = coef * price
+            rows = [
+                (src, res_code, res_desc, res_unit, f"{c:.4f}", f"R$ {p:,.2f}", f"R$ {st:,.2f}")
+                for src, res_code, res_desc, res_unit, c, p, st in zip(
+                    df['src'], df['res_code'], df['res_desc'], df['res_unit'], coef, price, subtotal)
+            ]
+            self.ins_rows_cache[code] = (rows, f"R$ {subtotal.sum():,.2f}")
+        return self.ins_rows_cache[code]
 
     def on_item_select(self, event):
         selected = self.tree_po.selection()
@@ -413,35 +522,16 @@ class OrcamentoApp:
         self.lbl_item_detail.config(text=f"Composição do Item: {code} - {desc}")
         
         # Limpar tree insumos
-        for i in self.tree_ins.get_children():
-            self.tree_ins.delete(i)
+        self.tree_ins.delete(*self.tree_ins.get_children())
             
         if self.df_insumos is None: return
-        
-        # Filtrar insumos
-        insumos = self.df_insumos[self.df_insumos['parent_code'].astype(str) == code]
-        
-        total_comp = 0.0
-        
-        for _, row in insumos.iterrows():
-            coef = float(row['coef']) if pd.notnull(row['coef']) else 0.0
-            price = float(row['price']) if pd.notnull(row['price']) else 0.0
-            subtotal = coef * price
-            total_comp += subtotal
-            
-            vals = (
-                row['src'],
-                row['res_code'],
-                row['res_desc'],
-                row['res_unit'],
-                f"{coef:.4f}",
-                f"R$ {price:,.2f}",
-                f"R$ {subtotal:,.2f}"
-            )
+
+        rows, total_str = self.composition_rows(code)
+        for vals in rows:
             self.tree_ins.insert("", tk.END, values=vals)
             
         # Adicionar linha de total
-        self.tree_ins.insert("", tk.END, values=("TOTAL", "", "", "", "", "", f"R$ {total_comp:,.2f}"), tags=('total',))
+        self.tree_ins.insert("", tk.END, values=("TOTAL", "", "", "", "", "", total_str), tags=('total',))
         self.tree_ins.tag_configure('total', font=('Arial', 10, 'bold'), background='#e6e6e6')
 
 if __name__ == "__main__":
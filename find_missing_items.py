@@ -1,12 +1,16 @@
 import pandas as pd
-import sqlite3
 import difflib
-from pathlib import Path
+from web_app.services.text_search import TokenIndex
+from web_app.services import project_db
 
 def normalize_text(text):
     if pd.isna(text): return ""
     return str(text).strip().upper()
 
+# Description matching: best candidates kept per item and minimum cosine similarity
+FUZZY_TOP_K = 3
+FUZZY_MIN_SCORE = 0.5
+
 def find_matches():
     print("Loading missing items...")
     df = pd.read_csv('tabela_servicos_export.csv')
@@ -14,26 +18,21 @@ def find_matches():
     
     print(f"Total Missing Items: {len(missing)}")
     
-    db_path = Path("dados/projeto.sqlite")
-    conn = sqlite3.connect(db_path)
-    
     # Load candidate tables
     # We'll prioritize tables that look like composition libraries
     
     # 1. Composicoes (General)
     print("Loading 'composicoes' from DB...")
-    df_comp = pd.read_sql_query("SELECT fonte, codigo, descricao, unidade FROM composicoes", conn)
+    df_comp = project_db.composicoes()
     
     # 2. Insumos Unificados (Maybe it's an insumo?)
     print("Loading 'insumos_unificados' from DB...")
-    df_insumos = pd.read_sql_query("SELECT fonte, codigo, descricao, unidade, preco_unitario FROM insumos_unificados", conn)
+    df_insumos = project_db.insumos_unificados()
     
     # 3. Composicoes Analiticas (Detailed)
     print("Loading 'composicoes_analiticas_analisadas_unitaria' from DB...")
     # This table seems to link items to compositions, might be useful for description matching
-    df_analitica = pd.read_sql_query("SELECT codigo_composicao as codigo, descricao, fonte_composicao as fonte FROM composicoes_analiticas_analisadas_unitaria GROUP BY codigo_composicao", conn)
-    
-    conn.close()
+    df_analitica = project_db.composicoes_analiticas()
     
     # Combine sources for searching
     # Add a 'type' col
@@ -49,102 +48,70 @@ def find_matches():
     ], ignore_index=True)
     
     # Normalize for matching
-    candidates['norm_code'] = candidates['codigo'].apply(normalize_text)
-    candidates['norm_desc'] = candidates['descricao'].apply(normalize_text)
-    
-    suggestions = []
-    
-    print("Starting matching process (this may take a while)...")
-    
-    for idx, row in missing.iterrows():
-        po_code = normalize_text(row['code'])
-        po_desc = normalize_text(row['desc'])
-        po_src = normalize_text(row['source'])
-        
-        # 1. Exact Code Match
-        # Filter by code first (fast)
-        code_matches = candidates[candidates['norm_code'] == po_code]
-        
-        for _, match in code_matches.iterrows():
-            suggestions.append({
-                'po_idx': row['idx'],
-                'po_code': row['code'],
-                'po_desc': row['desc'],
-                'found_code': match['codigo'],
-                'found_desc': match['descricao'],
-                'found_source': match['fonte'],
-                'db_type': match['db_type'],
-                'score': 100,
-                'match_type': 'EXACT_CODE'
-            })
-            
-        # 2. Description Match (Fuzzy) if no exact code match (or to find alternatives)
-        # Only if we haven't found a perfect match or if we want to be thorough
-        # Fuzzy matching is slow, so let's limit to items where we didn't find an exact code match from the SAME source
-        
-        has_exact_source_match = any((m['found_source'] == row['source']) for m in suggestions if m['po_idx'] == row['idx'])
-        
-        if not has_exact_source_match:
-            # Try to match description
-            # Use difflib.get_close_matches is too strict/slow for full DB?
-            # Let's simple keyword match first? Or just simple contains?
-            # For 1133 items x 20k candidates -> 20M checks. Too slow in Python loop.
-            # Let's rely on simple token overlap for speed or just skip for now?
-            # The user asked to "find compositions... missing".
-            # Let's try to match by Source + Code first (Strongest).
-            # Then Source + Partial Code?
-            # Then Description.
-            pass
-
-    # Let's refine the exact code match logic to be more robust
-    # Many times codes have formatting differences (e.g. 02.02.130 vs 2.2.130)
-    
-    # Re-run with normalized code comparison (removing dots/dashes)
+    # Many times codes have formatting differences (e.g. 02.02.130 vs 2.2.130):
+    # besides the normalized code we also match on the code without dots/dashes
     def clean_code(c):
         return str(c).replace('.','').replace('-','').strip().upper()
 
+    candidates['norm_code'] = candidates['codigo'].apply(normalize_text)
+    candidates['norm_desc'] = candidates['descricao'].apply(normalize_text)
     candidates['clean_code'] = candidates['norm_code'].apply(clean_code)
-    
-    count = 0
-    for idx, row in missing.iterrows():
-        po_clean = clean_code(row['code'])
-        if not po_clean: continue
-        
-        # Look for clean code match
-        matches = candidates[candidates['clean_code'] == po_clean]
-        
-        for _, match in matches.iterrows():
-            # Check if we already added this one
-            exists = False
-            for s in suggestions:
-                if s['po_idx'] == row['idx'] and s['found_code'] == match['codigo'] and s['found_source'] == match['fonte']:
-                    exists = True
-                    break
-            
-            if not exists:
-                score = 90
-                if normalize_text(match['fonte']) == normalize_text(row['source']):
-                    score = 100
-                
-                suggestions.append({
-                    'po_idx': row['idx'],
-                    'po_code': row['code'],
-                    'po_desc': row['desc'],
-                    'found_code': match['codigo'],
-                    'found_desc': match['descricao'],
-                    'found_source': match['fonte'],
-                    'db_type': match['db_type'],
-                    'score': score,
-                    'match_type': 'CLEAN_CODE_MATCH'
-                })
-        
-        count += 1
-        if count % 100 == 0:
-            print(f"Processed {count}/{len(missing)} items...")
+
+    po = pd.DataFrame({
+        'po_idx': missing['idx'],
+        'po_code': missing['code'],
+        'po_desc': missing['desc'],
+        'po_src': missing['source'].apply(normalize_text),
+    })
+    po['norm_code'] = missing['code'].apply(normalize_text)
+    po['clean_code'] = missing['code'].apply(clean_code)
+
+    # Empty codes (and NaN read back as 'NAN') would match every other empty code
+    no_code = ['', 'NAN', 'NONE']
+    cand = candidates[~candidates['norm_code'].isin(no_code)].rename(columns={
+        'codigo': 'found_code', 'descricao': 'found_desc', 'fonte': 'found_source'})
+    cols = ['po_idx', 'po_code', 'po_desc', 'found_code', 'found_desc', 'found_source', 'db_type', 'score', 'match_type']
+
+    print("Matching codes (hash join on normalized and clean codes)...")
+
+    # 1. Exact Code Match
+    exact = po[~po['norm_code'].isin(no_code)].merge(cand.drop(columns='clean_code'), on='norm_code')
+    exact['score'] = 100
+    exact['match_type'] = 'EXACT_CODE'
+
+    # 2. Clean code match: 100 when the source agrees with the PO, 90 otherwise
+    clean = po[~po['clean_code'].isin(no_code)].drop(columns='norm_code').merge(cand, on='clean_code')
+    clean['score'] = (clean['found_source'].apply(normalize_text) == clean['po_src']).map({True: 100, False: 90})
+    clean['match_type'] = 'CLEAN_CODE_MATCH'
+
+    # 3. Description match (TF-IDF over an inverted token index) for the items
+    # without a code match from their own source
+    solved = set(exact['po_idx']) | set(clean.loc[clean['score'] == 100, 'po_idx'])
+    pending = po[~po['po_idx'].isin(solved)]
+    docs = candidates[candidates['norm_desc'] != ''].drop_duplicates(['fonte', 'codigo', 'norm_desc']).reset_index(drop=True)
+    print(f"Indexing {len(docs)} descriptions for fuzzy matching of {len(pending)} items...")
+    index = TokenIndex(docs['descricao'].tolist())
+    hits = index.search(pending['po_desc'].tolist(), k=FUZZY_TOP_K, min_score=FUZZY_MIN_SCORE)
+
+    rows = [(i, d, s) for i, found in enumerate(hits) for d, s in found]
+    fuzzy = pending.iloc[[i for i, _, _ in rows]].reset_index(drop=True)
+    found = docs.iloc[[d for _, d, _ in rows]].reset_index(drop=True)
+    fuzzy['found_code'] = found['codigo']
+    fuzzy['found_desc'] = found['descricao']
+    fuzzy['found_source'] = found['fonte']
+    fuzzy['db_type'] = found['db_type']
+    fuzzy['score'] = [round(s * 100, 1) for _, _, s in rows]
+    fuzzy['match_type'] = 'FUZZY_DESC'
+    print(f"{len(fuzzy)} description matches for {fuzzy['po_idx'].nunique()} items.")
+
+    # Same item/code/source found by several passes: the code match wins
+    suggestions = pd.concat([exact[cols], clean[cols], fuzzy[cols]], ignore_index=True)
+    suggestions = suggestions.drop_duplicates(subset=['po_idx', 'found_code', 'found_source'])
+    print(f"{len(suggestions)} matches for {suggestions['po_idx'].nunique()} of {len(missing)} items.")
 
     # Export Report
-    if suggestions:
-        df_sug = pd.DataFrame(suggestions)
+    if len(suggestions):
+        df_sug = suggestions
         # Sort by PO Item then Score
         df_sug = df_sug.sort_values(['po_idx', 'score'], ascending=[True, False])
         
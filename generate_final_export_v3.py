@@ -1,317 +1,190 @@
+import os
 import pandas as pd
 import numpy as np
-import sqlite3
 from pathlib import Path
+from openpyxl.utils import get_column_letter
+from web_app.services import loader_tasks, project_db, result_store
+from web_app.services.pricing_engine import PricingEngine, build_groups, GROUPS, GROUP_FIELDS
+from web_app.services.bom import BomExplosion
 
-def normalize_val(v):
-    if pd.isna(v): return None
-    s = str(v).strip().upper()
-    if s.endswith('.0'): s = s[:-2]
-    return s
-
-def run_final_export_v3():
-    print("Loading PO items...")
-    # PO.xlsx: Data starts around row 12.
-    po_df = pd.read_excel("PO.xlsx", sheet_name="PO", skiprows=12, header=None)
-    po_items = []
-    po_prices = {} # code -> price
-    required_codes = set()
-    
-    for _, row in po_df.iterrows():
-        po_idx = str(row[0]).strip()
-        # Debug
-        if po_idx.startswith('1.1'):
-             print(f"DEBUG ROW: {po_idx} - {row[1]} - {row[2]}")
-             pass
-
-        if po_idx == 'nan' or po_idx == 'ITEM': continue
-        
-        source = normalize_val(row[1])
-        code = normalize_val(row[2])
-        desc = row[3]
-        unit = row[4]
-        try:
-            qty = float(row[5]) if not pd.isna(row[5]) else 0.0
-        except:
-            qty = 0.0
-        
-        item_type = "ITEM"
-        
-        # Header Detection
-        if not source:
-            # If source is empty, it's likely a header.
-            # Title might be in Col 2 (Code) or Col 3 (Desc).
-            # Based on inspection: Col 2 has the text.
-            item_type = "HEADER"
-            if code and (pd.isna(desc) or str(desc).strip() == ""):
-                desc = row[2] # Use Col 2 as desc
-                code = "" # Clear code
-            elif not code and not pd.isna(desc):
-                 # Normal header in desc col?
-                 pass
-        
-        # Capture manual price
+# Stages reported to the progress callback, in order
+STAGES = ("PO", "SINAPI", "CDHU", "SICRO", "COTACOES", "STATUS", "CURVA_ABC", "EXPORT")
+
+def write_csv(df, path, outputs):
+    # Written to a temp file next to path and renamed by publish() at the very end,
+    # so a cancelled / failed run never leaves a truncated export behind
+    tmp = f"{path}.tmp"
+    df.to_csv(tmp, index=False, encoding="utf-8-sig")
+    outputs.append((tmp, path))
+
+def publish(outputs):
+    for tmp, path in outputs:
+        os.replace(tmp, path)
+
+def with_sub_compositions(codes, comp_map):
+    # Transitive closure: codes plus every composition / insumo below them
+    queue = list(codes)
+    visited = set(codes)
+    while queue:
+        curr = queue.pop(0)
+        if curr in comp_map:
+            for child in comp_map[curr]:
+                c_code = child['code']
+                if c_code not in visited:
+                    visited.add(c_code)
+                    queue.append(c_code)
+    return visited
+
+def run_final_export_v3(progress=None):
+    # progress(stage, rows): called when each of STAGES is done, rows = rows it produced
+    def done(stage, rows):
+        if progress:
+            progress(stage, rows)
+
+    f_po = "PO.xlsx"
+    f_sinapi = "SINAPI_Referência_2024_08.xlsx"
+    f_cdhu = "TABELA COMPLETA CDHU.xlsx"
+    f_sicro = "CE 07-2025 Relatório Analítico de Composições de Custos.xlsx"
+    outputs = [] # (temp file, final name) of every CSV written, see write_csv
+
+    # --- 0. Workbooks (independent tasks, run in parallel) ---
+    # SICRO waits on sicro_filter for the compositions to keep: the PO codes and
+    # their SINAPI sub-compositions, sent as soon as PO and SINAPI are parsed.
+    with loader_tasks.task_feed() as sicro_filter:
+        tasks = {"PO": (loader_tasks.parse_po_task, (f_po,))}
+        if Path(f_sinapi).exists():
+            tasks["SINAPI"] = (loader_tasks.parse_sinapi_task, (f_sinapi,))
+        if Path(f_cdhu).exists():
+            tasks["CDHU"] = (loader_tasks.parse_cdhu_task, (f_cdhu,))
+        if Path(f_sicro).exists():
+            tasks["SICRO"] = (loader_tasks.parse_sicro_task, (f_sicro, sicro_filter))
+        waiting = {"PO", "SINAPI"} & set(tasks)
+        finished = {}
+
+        def on_done(name, result):
+            finished[name] = result
+            if name == "PO":
+                done("PO", len(result["po_items"]))
+            if name in waiting:
+                waiting.discard(name)
+                if not waiting:
+                    comp_map = finished["SINAPI"]["comp_map"] if "SINAPI" in finished else {}
+                    sicro_filter.put(with_sub_compositions(finished["PO"]["po_prices"], comp_map))
+
+        print(f"Parsing {len(tasks)} workbooks ({', '.join(tasks)})...")
         try:
-            p_val = row[8]
-            if isinstance(p_val, str): p_val = p_val.replace(',', '.')
-            p_float = float(p_val)
-        except:
-            p_float = 0.0
-
-        # We include everything now, distinguishing via item_type
-        po_items.append({
-            "idx": po_idx, 
-            "source": source, 
-            "code": code, 
-            "desc": desc, 
-            "unit": unit,
-            "qty": qty,
-            "manual_price": p_float,
-            "type": item_type
-        })
-        
-        if code and item_type == "ITEM":
-            po_prices[code] = p_float
-            required_codes.add(code)
-
-    # DB Cotações
-    db_path = Path("dados/projeto.sqlite")
-    conn = sqlite3.connect(db_path)
-    db_mapped = pd.read_sql_query("SELECT po_item, codigo as m_code FROM validacoes_cot", conn)
-    db_prices = pd.read_sql_query("SELECT codigo, descricao, valor_material FROM cotacoes_aba", conn)
-    db_map = dict(zip(db_mapped['po_item'], db_mapped['m_code']))
-    db_price = db_prices.set_index('codigo').to_dict('index')
-    conn.close()
+            parsed = loader_tasks.run_tasks(tasks, on_done=on_done)
+        except BaseException:
+            sicro_filter.put(set()) # let a SICRO task still waiting end (nothing to keep)
+            raise
+    for name in tasks:
+        print(parsed[name]["log"], end="")
+
+    po_items, po_prices = parsed["PO"]["po_items"], parsed["PO"]["po_prices"] # po_prices: code -> price
+    required_codes = set(po_prices)
+
+    # DB Cotações: validated cotação of each PO item (indexed join, see project_db)
+    try:
+        db_cot = project_db.cotacoes_for_po_items(item['idx'] for item in po_items)
+    except FileNotFoundError as e:
+        print(f"{e}: no cotações added.")
+        db_cot = pd.DataFrame(columns=["po_item", "codigo", "descricao", "valor_material"])
 
     final_insumos = []
     expanded_items = set() # Track which PO items got components
 
     # --- 1. SINAPI ---
-    f_sinapi = "SINAPI_Referência_2024_08.xlsx"
     sinapi_prices = {}
-    if Path(f_sinapi).exists():
-        print(f"Loading SINAPI Prices from {f_sinapi} (ISD & CSD)...")
-        
-        def load_prices(sheet_name, price_col_idx):
-            try:
-                # Skip 10 rows (Headers are in first 10 rows, data starts row 10)
-                df_x = pd.read_excel(f_sinapi, sheet_name=sheet_name, header=None, skiprows=10)
-                loaded_count = 0
-                for _, row in df_x.iterrows():
-                    # Code is always Col 1
-                    raw_c = row[1]
-                    if pd.isna(raw_c): continue
-                    
-                    c_x = str(raw_c).strip()
-                    if c_x.endswith('.0'): c_x = c_x[:-2]
-                    
-                    if c_x:
-                        # Price column varies by sheet
-                        # PATCH LOGIC: If target column is empty/zero, scan row for first float > 0
-                        val_float = 0.0
-                        found = False
-                        
-                        # Try primary column
-                        if price_col_idx < len(row):
-                            p_val = row[price_col_idx]
-                            try:
-                                if isinstance(p_val, str): p_val = p_val.replace(',', '.')
-                                val_float = float(p_val)
-                                if val_float > 0: found = True
-                            except:
-                                pass
-                        
-                        # Fallback: Scan row if not found or zero (and we suspect it might be elsewhere)
-                        # We scan from col 4 onwards to avoid code/desc
-                        if not found or val_float == 0:
-                            for idx in range(4, len(row)):
-                                if idx == price_col_idx: continue
-                                try:
-                                    v = row[idx]
-                                    if isinstance(v, (int, float)) and not pd.isna(v) and v > 0:
-                                        val_float = float(v)
-                                        found = True
-                                        # print(f"PATCH: Found price for {c_x} in col {idx}: {val_float}")
-                                        break
-                                except:
-                                    pass
-
-                        if found:
-                            sinapi_prices[c_x] = val_float
-                            loaded_count += 1
-                            
-                            # Debug specific codes
-                            if c_x in ["34547", "88316"]:
-                                print(f"DEBUG LOAD {sheet_name}: Found {c_x} -> {val_float}")
-                                
-                print(f"Loaded {loaded_count} items from {sheet_name}")
-            except Exception as e:
-                print(f"Error loading {sheet_name}: {e}")
-
-        # Code=Col 1 (Index 1). Price (SP)=Col 30 (ISD) and Col 54 (CSD).
-        load_prices("ISD", 30)
-        load_prices("CSD", 54)
-        
-        print(f"Total prices loaded: {len(sinapi_prices)}")
+    insumo_classes = {} # code -> ISD classification, for the MAT/MO/EQP/OUT split
+    price_sources = {} # code -> (sheet, column index, fallback?) the loaded price came from
+    engine = None
+    if "SINAPI" in parsed:
+        sinapi = parsed["SINAPI"]
+        sinapi_prices.update(sinapi["prices"])
+        insumo_classes.update(sinapi["classes"])
+        price_sources.update(sinapi["sources"])
+        comp_map = sinapi["comp_map"]
 
-        print(f"Parsing {f_sinapi} (Analítico)...")
-        # Read Analítico (Structural)
-        df = pd.read_excel(f_sinapi, sheet_name="Analítico", header=None, skiprows=5)
+        # Audit trail: which sheet/column each loaded price was read from
+        write_csv(pd.DataFrame(
+            [(code, sheet, get_column_letter(col + 1), col, fallback, sinapi_prices[code])
+             for code, (sheet, col, fallback) in price_sources.items()],
+            columns=["code", "sheet", "column", "col_index", "fallback", "price"],
+        ), "relatorio_origem_precos.csv", outputs)
+        n_fallback = sum(1 for _, _, fallback in price_sources.values() if fallback)
+        print(f"{n_fallback} prices taken from a fallback column (see relatorio_origem_precos.csv)")
 
-        # --- Iterative Calculation of Composition Prices ---
-        print("Building composition dependency map for price calculation...")
-        comp_map = {} # parent -> list of {code, coef}
-        current_comp_calc = None
+        # --- Calculation of Composition Prices ---
+        print(f"Pricing {len(comp_map)} compositions in dependency order...")
 
-        # Pass 1: Build dependency map
-        for _, row in df.iterrows():
-            c_comp = normalize_val(row[1])
-            if not c_comp: continue
-            
-            tipo = str(row[2]).strip().upper()
-            if tipo in ["NAN", "", "NONE"] or pd.isna(row[2]):
-                current_comp_calc = c_comp
-                if current_comp_calc not in comp_map:
-                    comp_map[current_comp_calc] = []
-            elif current_comp_calc:
-                # Component
-                r_code = normalize_val(row[3])
-                if not r_code: continue
-                
-                try:
-                    coef = float(row[6]) if not pd.isna(row[6]) else 0.0
-                except:
-                    coef = 0.0
-                
-                comp_map[current_comp_calc].append({'code': r_code, 'coef': coef})
-        
-        print(f"Mapped {len(comp_map)} compositions. Starting iterative calculation...")
-        
-        # Pass 2: Iterative Calculation
-        for i in range(15): # Max 15 passes
-            added_count = 0
-            for parent, children in comp_map.items():
-                if parent in sinapi_prices:
-                    continue # Already calculated or loaded
-                
-                total = 0.0
-                ready = True
-                
-                for child in children:
-                    c_code = child['code']
-                    c_coef = child['coef']
-                    
-                    if c_code in sinapi_prices:
-                        total += sinapi_prices[c_code] * c_coef
-                    else:
-                        if c_code in comp_map:
-                            ready = False
-                            break
-                        else:
-                            # Missing input, assume 0
-                            pass
-                
-                if ready:
-                    sinapi_prices[parent] = total
-                    added_count += 1
-            
-            print(f"Pass {i+1}: Calculated {added_count} new composition prices.")
-            if added_count == 0:
-                break
+        # Single topological pass over the dependency DAG
+        engine = PricingEngine(comp_map, sinapi_prices, build_groups(comp_map, insumo_classes))
+        engine.calculate(sinapi_prices)
+        engine.report()
         
         print(f"Total prices after calculation: {len(sinapi_prices)}")
 
         # --- Expand required_codes to include all sub-compositions (Transitive Closure) ---
         print("Expanding export list to include sub-compositions...")
-        queue = list(required_codes)
-        visited_exp = set(required_codes)
-        while queue:
-            curr = queue.pop(0)
-            if curr in comp_map:
-                for child in comp_map[curr]:
-                    c_code = child['code']
-                    if c_code not in visited_exp:
-                        visited_exp.add(c_code)
-                        queue.append(c_code)
-        
-        required_codes = visited_exp
+        required_codes = with_sub_compositions(required_codes, comp_map)
         print(f"Total items to export details for: {len(required_codes)}")
 
         # --- Export Pass ---
-        current_comp = None
-        for _, row in df.iterrows():
-            c_comp = normalize_val(row[1])
-            if not c_comp: continue
-            tipo = str(row[2]).strip().upper()
-            
-            # Identify Composition Header
-            if tipo in ["NAN", "", "NONE"] or pd.isna(row[2]):
-                current_comp = c_comp
-            elif current_comp in required_codes:
-                # It's an item inside the composition
-                r_code = normalize_val(row[3])
-                if not r_code: continue
-                
-                price = sinapi_prices.get(r_code, 0.0)
-                
+        for parent, children in comp_map.items():
+            if parent not in required_codes: continue
+            for child in children:
                 final_insumos.append({
-                    "parent_code": current_comp, "src": "SINAPI", "res_code": r_code,
-                    "res_desc": row[4], "res_unit": row[5], "coef": row[6], "price": price
+                    "parent_code": parent, "src": "SINAPI", "res_code": child['code'],
+                    "res_desc": child['desc'], "res_unit": child['unit'], "coef": child['coef'],
+                    "price": sinapi_prices.get(child['code'], 0.0)
                 })
-                expanded_items.add(current_comp)
+            if children:
+                expanded_items.add(parent)
+
+    done("SINAPI", len(final_insumos))
 
     # --- 2. CDHU ---
-    f_cdhu = "TABELA COMPLETA CDHU.xlsx"
-    if Path(f_cdhu).exists():
-        print(f"Parsing {f_cdhu}...")
-        df = pd.read_excel(f_cdhu, sheet_name="Composição", header=None)
-        current_comp = None
-        for _, row in df.iterrows():
-            c1 = normalize_val(row[0])
-            if not c1: continue
-            if pd.isna(row[3]): current_comp = c1
-            elif current_comp in required_codes:
-                price = row[4] if len(row) > 4 else 0
-                final_insumos.append({
-                    "parent_code": current_comp, "src": "CDHU", "res_code": c1,
-                    "res_desc": row[1], "res_unit": row[2], "coef": row[3], "price": price
-                })
-                expanded_items.add(current_comp)
+    if "CDHU" in parsed:
+        cdhu_items = parsed["CDHU"]["items"]
+        cdhu_items = cdhu_items[cdhu_items['parent_code'].isin(required_codes)]
+        final_insumos.extend(cdhu_items.to_dict('records'))
+        expanded_items.update(cdhu_items['parent_code'])
+
+    done("CDHU", len(final_insumos))
 
     # --- 3. SICRO (THE BIG ONE) ---
-    f_sicro = "CE 07-2025 Relatório Analítico de Composições de Custos.xlsx"
-    if Path(f_sicro).exists():
-        print(f"Parsing {f_sicro} (200k rows)...")
-        df = pd.read_excel(f_sicro, sheet_name=0, header=None)
-        current_comp = None
-        for _, row in df.iterrows():
-            col0 = normalize_val(row[0])
-            if col0 in required_codes and not pd.isna(row[1]) and pd.isna(row[3]):
-                current_comp = col0
-            elif current_comp and not pd.isna(row[1]) and not pd.isna(row[3]):
-                price = row[5] if len(row) > 5 else 0
-                final_insumos.append({
-                    "parent_code": current_comp, "src": "SICRO", "res_code": col0,
-                    "res_desc": row[1], "res_unit": row[4] if not pd.isna(row[4]) else row[3],
-                    "coef": row[2] if not pd.isna(row[2]) else row[3],
-                    "price": price
-                })
-                expanded_items.add(current_comp)
-            if col0 and col0 != current_comp and col0 not in required_codes and not pd.isna(row[1]) and pd.isna(row[3]):
-                current_comp = None
+    price_splits = {} # code -> per-group unit prices for codes priced outside the SINAPI engine
+    sicro_items = None
+    if "SICRO" in parsed:
+        sicro = parsed["SICRO"]
+        sicro_prices, sicro_items = sicro["prices"], sicro["items"]
+        print(f"Kept {len(sicro_prices)} SICRO compositions required by the PO.")
+
+        # SICRO prices join the same price table as SINAPI
+        for rec in sicro_prices.to_dict('records'):
+            code = rec['code']
+            if code in sinapi_prices: continue
+            sinapi_prices[code] = rec['price']
+            price_splits[code] = {g: rec[GROUP_FIELDS[g]] for g in GROUPS}
+
+        final_insumos.extend(sicro_items.to_dict('records'))
+        expanded_items.update(sicro_items['parent_code'])
+
+    done("SICRO", len(final_insumos))
 
     # --- 4. COTAÇÕES / DB ---
     print("Adding Database Cotacoes...")
+    db_map = db_cot.set_index('po_item').to_dict('index')
     for item in po_items:
         if item['idx'] in db_map:
-            m_code = db_map[item['idx']]
-            if m_code in db_price:
-                p = db_price[m_code]
-                final_insumos.append({
-                    "parent_code": item['code'], "src": "MERCADO", "res_code": m_code,
-                    "res_desc": p['descricao'], "res_unit": "UN", "coef": 1, "price": p['valor_material']
-                })
-                expanded_items.add(item['code'])
+            p = db_map[item['idx']]
+            final_insumos.append({
+                "parent_code": item['code'], "src": "MERCADO", "res_code": p['codigo'],
+                "res_desc": p['descricao'], "res_unit": "UN", "coef": 1, "price": p['valor_material']
+            })
+            expanded_items.add(item['code'])
+
+    done("COTACOES", len(final_insumos))
 
     # --- 5. FALLBACK / SELF-REFERENCE & STATUS CALCULATION ---
     print("Checking for missing items and applying Fallback/PO Price...")
@@ -379,13 +252,62 @@ def run_final_export_v3():
         item['final_price'] = price
         item['method'] = method
         item['status'] = status
+        if method == 'CALCULATED' and code in price_splits:
+            split = price_splits[code]
+        elif engine:
+            split = engine.split_price(code, price)
+        else:
+            split = dict.fromkeys(GROUPS, 0.0)
+            split['OUT'] = price
+        for group in GROUPS:
+            item[GROUP_FIELDS[group]] = split[group]
         final_po_export.append(item)
 
+    done("STATUS", len(final_po_export))
+
+    # --- 6. CURVA ABC (whole-PO bill of materials) ---
+    # Only compositions whose price is built from their children are exploded:
+    # calculated SINAPI ones and SICRO. Everything else is an insumo at its own price.
+    structure = {}
+    if engine:
+        structure.update({p: comp_map[p] for p in engine.order})
+    bom_prices = dict(sinapi_prices)
+    descs, units = {}, {}
+    for ins in final_insumos:
+        descs.setdefault(ins['res_code'], ins['res_desc'])
+        units.setdefault(ins['res_code'], ins['res_unit'])
+    if sicro_items is not None:
+        for rec in sicro_items.to_dict('records'):
+            if rec['parent_code'] in price_splits:
+                structure.setdefault(rec['parent_code'], []).append({'code': rec['res_code'], 'coef': rec['coef']})
+                bom_prices.setdefault(rec['res_code'], rec['price'])
+    # PO lines not priced from their children (PO_MANUAL, SINAPI_DIRECT...) stay whole
+    # at their final price, even when the code has a structure
+    def exploded(item):
+        return item['method'] == 'CALCULATED' and item['code'] in structure
+    for item in final_po_export:
+        if item['type'] != 'HEADER' and not exploded(item):
+            bom_prices[item['code']] = item['final_price']
+            descs.setdefault(item['code'], item['desc'])
+            units.setdefault(item['code'], item['unit'])
+    abc = BomExplosion(structure).table(final_po_export, bom_prices, descs, units, exploded)
+    write_csv(abc, "curva_abc_insumos.csv", outputs)
+    print(f"Curva ABC: {len(abc)} insumos, {(abc['abc'] == 'A').sum()} in class A.")
+    done("CURVA_ABC", len(abc))
+
     # Export
-    pd.DataFrame(final_po_export).to_csv("tabela_servicos_export.csv", index=False, encoding="utf-8-sig")
+    servicos_df = pd.DataFrame(final_po_export)
+    write_csv(servicos_df, "tabela_servicos_export.csv", outputs)
     final_df = pd.DataFrame(final_insumos)
-    final_df.to_csv("tabela_insumos_export.csv", index=False, encoding="utf-8-sig")
+    write_csv(final_df, "tabela_insumos_export.csv", outputs)
+
+    # Result store: same data in indexed tables, only the rows that changed are rewritten
+    run_id, stats = result_store.save_run(servicos_df, final_df)
+    print(f"Run {run_id} saved to {result_store.STORE_PATH}: " +
+          ", ".join(f"{t} {w} written/{d} removed" for t, (w, d) in stats.items()))
+    publish(outputs)
     print(f"Export V3 FINISHED. Total Insumos: {len(final_insumos)}")
+    done("EXPORT", len(final_po_export) + len(final_insumos))
 
 if __name__ == "__main__":
     run_final_export_v3()
@@ -1,21 +1,11 @@
-import sqlite3
-
-db_path = "dados/projeto.sqlite"
-conn = sqlite3.connect(db_path)
-cursor = conn.cursor()
+from web_app.services import project_db
 
 # Get table names
-cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-tables = cursor.fetchall()
-print("Tables:", [t[0] for t in tables])
+tables = project_db.table_names()
+print("Tables:", tables)
 
 # Get columns for each table
-for table in tables:
-    t_name = table[0]
-    cursor.execute(f"PRAGMA table_info({t_name})")
-    columns = cursor.fetchall()
+for t_name in tables:
     print(f"\nTable: {t_name}")
-    for col in columns:
-        print(f"  {col[1]} ({col[2]})")
-
-conn.close()
+    for name, col_type in project_db.table_columns(t_name):
+        print(f"  {name} ({col_type})")
@@ -0,0 +1,114 @@
+import importlib.util
+import multiprocessing as mp
+import os
+import queue
+import sys
+import time
+import traceback
+
+# Runs generate_final_export_v3 in a separate process. The GUI never touches
+# the worker's stdout: everything comes back as dict events on a queue that
+# the Tk loop polls with root.after():
+#   {"type": "log", "text": ...}
+#   {"type": "progress", "stage": ..., "step": n, "steps": total, "rows": ..., "elapsed": s}
+#   {"type": "done", "ok": True/False, "error": ..., "elapsed": s}
+SCRIPT = "generate_final_export_v3.py"
+
+
+class QueueWriter:
+    # sys.stdout of the worker: one "log" event per line
+    def __init__(self, events):
+        self.events = events
+        self.buffer = ""
+
+    def write(self, text):
+        self.buffer += text
+        while "\n" in self.buffer:
+            line, self.buffer = self.buffer.split("\n", 1)
+            self.events.put({"type": "log", "text": line})
+
+    def flush(self):
+        if self.buffer:
+            self.events.put({"type": "log", "text": self.buffer})
+            self.buffer = ""
+
+
+def _worker(events, script_path):
+    start = time.time()
+    sys.stdout = sys.stderr = QueueWriter(events)
+    try:
+        spec = importlib.util.spec_from_file_location("generate_final_export_v3", script_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        steps = len(module.STAGES)
+
+        def progress(stage, rows):
+            events.put({
+                "type": "progress", "stage": stage, "step": module.STAGES.index(stage) + 1,
+                "steps": steps, "rows": rows, "elapsed": time.time() - start,
+            })
+
+        module.run_final_export_v3(progress=progress)
+        sys.stdout.flush()
+        events.put({"type": "done", "ok": True, "error": None, "elapsed": time.time() - start})
+    except Exception as e:
+        traceback.print_exc()
+        sys.stdout.flush()
+        events.put({"type": "done", "ok": False, "error": str(e), "elapsed": time.time() - start})
+
+
+class RecalcJob:
+    def __init__(self, script_path=SCRIPT):
+        self.script_path = os.path.abspath(script_path)
+        self.events = None
+        self.process = None
+        self.started = None
+        self.finished = False
+        self.cancelled = False
+
+    def start(self):
+        if self.is_running():
+            raise RuntimeError("Recalculation already running")
+        ctx = mp.get_context("spawn")
+        # Not a daemon: the export parses its workbooks in a process pool of its own
+        self.events = ctx.Queue()
+        self.process = ctx.Process(target=_worker, args=(self.events, self.script_path), daemon=False)
+        self.started = time.time()
+        self.finished = False
+        self.cancelled = False
+        self.process.start()
+
+    def is_running(self):
+        return self.process is not None and not self.finished
+
+    def cancel(self):
+        # Doesn't wait for the process to go: poll() reports the "done" event once it has
+        # (the export only renames its CSVs into place at the very end, see write_csv)
+        if self.process is not None and self.process.is_alive():
+            self.cancelled = True
+            self.process.terminate()
+
+    def poll(self):
+        """Events received since the last call (never blocks)."""
+        out = []
+        if self.events is None or self.finished:
+            return out
+        alive = self.process.is_alive()
+        while True:
+            try:
+                ev = self.events.get_nowait()
+            except queue.Empty:
+                break
+            ev.setdefault("cancelled", False)
+            out.append(ev)
+            if ev["type"] == "done":
+                self.finished = True
+        if not self.finished and not alive:
+            # Killed (cancel) or died without reporting
+            self.finished = True
+            out.append({
+                "type": "done", "ok": False, "cancelled": self.cancelled,
+                "error": "cancelled" if self.cancelled else f"worker exited with code {self.process.exitcode}",
+                "elapsed": time.time() - self.started,
+            })
+        return out
@@ -1,23 +1,48 @@
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, Request, Body, Depends, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 import uvicorn
 from contextlib import asynccontextmanager
 from .services.data_loader import OrcamentoService
+from .services.json_payload import dumps
+from .services.snapshot import ServiceSnapshots, FileWatcher, watch_enabled, watched_files, WATCH_ENV
 
-service = OrcamentoService()
+# The OrcamentoService being served; /api/reload (or the watcher) swaps in a new one
+snapshots = ServiceSnapshots()
+
+# Seconds a client is told to wait (Retry-After) while the data is still loading
+RETRY_AFTER = 2
+
+def reload_on_change(changed):
+    print(f"Changed: {', '.join(changed)}. Reloading...")
+    return snapshots.reload("watch: " + ", ".join(changed))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Load data on startup
-    print("Initializing Data Service...")
-    service.load_and_calculate()
+    # Load data on startup, without holding the server: the page and /api/status
+    # answer right away, data endpoints return 503 until the first load is done
+    print("Initializing Data Service (background)...")
+    snapshots.reload("startup")
+    watcher = None
+    if watch_enabled():
+        watcher = FileWatcher(watched_files(OrcamentoService()), reload_on_change)
+        watcher.start()
+        print(f"{WATCH_ENV}=1: watching {', '.join(p.name for p in watcher.paths)}")
     yield
     # Clean up
+    if watcher:
+        watcher.stop()
 
 app = FastAPI(lifespan=lifespan)
 
+def loaded_service():
+    # Each request works on the snapshot current when it arrived, even if a reload swaps it meanwhile
+    service = snapshots.current
+    if service is None:
+        raise HTTPException(status_code=503, detail=snapshots.status(), headers={"Retry-After": str(RETRY_AFTER)})
+    return service
+
 templates = Jinja2Templates(directory="web_app/templates")
 
 # If we had static files
@@ -27,29 +52,87 @@ templates = Jinja2Templates(directory="web_app/templates")
 async def read_root(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
+def payload_response(request: Request, payload):
+    # Pre-serialised JSON: 304 when the client already has it, gzip when accepted
+    headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    use_gzip = "gzip" in request.headers.get("accept-encoding", "")
+    headers["ETag"] = payload.gzip_etag if use_gzip else payload.etag
+    if payload.matches(request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(payload.gzip_body, media_type="application/json", headers=headers)
+    return Response(payload.body, media_type="application/json", headers=headers)
+
+@app.get("/api/status")
+async def get_status():
+    # state: idle / loading / ready / error, with the current stage while loading
+    return JSONResponse(content=snapshots.status())
+
+@app.post("/api/reload")
+async def reload_data():
+    # Re-read the workbooks into a new snapshot; the current one keeps serving until it is ready
+    started = snapshots.reload("api")
+    return JSONResponse(status_code=202, content={"started": started, "status": snapshots.status()})
+
 @app.get("/api/grid")
-async def get_grid_data():
-    data = service.get_grid_data()
-    return JSONResponse(content=data)
+async def get_grid_data(request: Request, service: OrcamentoService = Depends(loaded_service)):
+    return payload_response(request, service.get_grid_payload())
+
+@app.post("/api/grid/rows")
+async def get_grid_rows(body: dict = Body(...), service: OrcamentoService = Depends(loaded_service)):
+    # AG Grid infinite row model: {startRow, endRow, sortModel, filterModel[, locateIdx]}
+    # -> {"rows": [...], "lastRow": n[, "rowIndex": position of locateIdx]}
+    try:
+        data = service.get_grid_rows(
+            body.get("startRow", 0), body.get("endRow", 100),
+            body.get("sortModel"), body.get("filterModel"), body.get("locateIdx"))
+    except (ValueError, TypeError, KeyError) as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return Response(dumps(data), media_type="application/json")
 
 @app.get("/api/eap")
-async def get_eap_data():
-    # Return simplified list for EAP tree
-    items = service.get_grid_data()
-    # Filter only headers or meaningful items?
-    # Or return full list and let frontend build tree
-    return JSONResponse(content=items)
+async def get_eap_data(request: Request, service: OrcamentoService = Depends(loaded_service)):
+    # Same list as the grid; the frontend builds the tree from idx
+    return payload_response(request, service.get_grid_payload())
 
 @app.get("/api/composition/{code}")
-async def get_composition_json(code: str):
-    data = service.get_composition(code)
+async def get_composition_json(code: str, service: OrcamentoService = Depends(loaded_service)):
+    # Serialised when the composition was (re)priced
+    return Response(service.get_composition_json(code), media_type="application/json")
+
+@app.get("/api/insumo/{code}/usage")
+async def get_insumo_usage(code: str, service: OrcamentoService = Depends(loaded_service)):
+    # Every composition / PO item that uses the insumo, quantity consumed and R$ impact
+    data = service.get_insumo_usage(code.strip().upper())
+    return JSONResponse(content=data)
+
+@app.get("/api/abc")
+async def get_abc_curve(service: OrcamentoService = Depends(loaded_service)):
+    # Whole-PO bill of materials: quantity and cost per insumo, ABC classified
+    data = service.get_abc_curve()
+    return JSONResponse(content=data)
+
+@app.post("/api/simulate")
+async def simulate_prices(overrides: dict[str, float] = Body(...), service: OrcamentoService = Depends(loaded_service)):
+    # What-if: {"<insumo or composition code>": new_price, ...} -> PO items whose price would change
+    data = service.simulate_prices(overrides)
+    return JSONResponse(content=data)
+
+@app.post("/api/price/{code}")
+async def update_price(code: str, price: float = Body(..., embed=True), service: OrcamentoService = Depends(loaded_service)):
+    # Change one insumo price and get back what moved (on a new snapshot, see ServiceSnapshots)
+    try:
+        data = snapshots.update_price(code.strip().upper(), price)
+    except KeyError as e:
+        return JSONResponse(status_code=404, content={"error": e.args[0]})
     return JSONResponse(content=data)
 
 @app.get("/api/item/{code}", response_class=HTMLResponse)
-async def get_item_details(request: Request, code: str):
+async def get_item_details(request: Request, code: str, service: OrcamentoService = Depends(loaded_service)):
     # Return HTML snippet for Inspector
     # Find item in PO items
-    item = next((i for i in service.po_items if i['code'] == code), None)
+    item = service.get_item(code)
     
     if not item:
         return "<div>Item não encontrado</div>"
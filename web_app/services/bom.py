@@ -0,0 +1,100 @@
+from collections import defaultdict
+
+import pandas as pd
+
+# ABC curve cut-offs on the cumulative share of the cost
+ABC_LIMITS = (("A", 0.80), ("B", 0.95), ("C", 1.0))
+
+
+class BomExplosion:
+    """Bill of materials of the whole PO down to the insumos.
+
+    structure is parent -> list of {'code', 'coef'} for the compositions that
+    are priced from their children (anything else is an insumo). The unit
+    explosion of a composition (insumo -> qty per unit) is computed once and
+    reused by every PO line and every composition that shares it, so the
+    whole budget is one pass over the distinct compositions plus one merge
+    per PO line.
+
+    A PO line is only exploded when explode(item) says its price was built
+    from the children; any other line (e.g. priced from the PO itself) is
+    an insumo at its own price, so the curve adds up to the budget.
+    """
+
+    def __init__(self, structure):
+        self.structure = structure
+        self._unit = {}
+
+    def unit(self, code):
+        """insumo -> quantity in one unit of code (memoised)."""
+        if code in self._unit:
+            return self._unit[code]
+        if code not in self.structure:
+            return {code: 1.0}
+        # Iterative post-order so deep hierarchies do not hit the recursion limit
+        stack = [(code, False)]
+        in_progress = set()
+        while stack:
+            node, ready = stack.pop()
+            if node in self._unit:
+                continue
+            children = self.structure[node]
+            if not ready:
+                in_progress.add(node)
+                stack.append((node, True))
+                for child in children:
+                    c = child['code']
+                    if c in self.structure and c not in self._unit and c not in in_progress:
+                        stack.append((c, False))
+                continue
+            acc = defaultdict(float)
+            for child in children:
+                c, coef = child['code'], child['coef']
+                # A self reference / cycle member still being built counts as an insumo
+                sub = self._unit.get(c) if c != node else None
+                if sub is None:
+                    acc[c] += coef
+                else:
+                    for leaf, q in sub.items():
+                        acc[leaf] += coef * q
+            self._unit[node] = dict(acc)
+            in_progress.discard(node)
+        return self._unit[code]
+
+    def totals(self, po_items, explode=None):
+        """insumo -> quantity consumed by the whole PO."""
+        total = defaultdict(float)
+        for item in po_items:
+            if item['type'] == 'HEADER' or not item['code'] or not item['qty']:
+                continue
+            qty = item['qty']
+            if explode is not None and not explode(item):
+                total[item['code']] += qty
+                continue
+            for leaf, q in self.unit(item['code']).items():
+                total[leaf] += qty * q
+        return total
+
+    def table(self, po_items, prices, descs=None, units=None, explode=None):
+        """Per-insumo quantity and cost with the ABC classification, biggest cost first."""
+        total = self.totals(po_items, explode)
+        df = pd.DataFrame({"code": list(total), "qty": list(total.values())})
+        df["desc"] = df["code"].map(descs or {})
+        df["unit"] = df["code"].map(units or {})
+        df["unit_price"] = df["code"].map(prices).fillna(0.0).astype(float)
+        df["cost"] = df["qty"] * df["unit_price"]
+        return abc_curve(df)
+
+
+def abc_curve(df, value="cost"):
+    df = df.sort_values(value, ascending=False, kind="stable").reset_index(drop=True)
+    total = df[value].sum()
+    df["share"] = df[value] / total if total else 0.0
+    df["cum_share"] = df["share"].cumsum()
+    # An item is in the class where its cumulative share *starts*, so the
+    # item crossing 80% is still an A
+    start = df["cum_share"] - df["share"]
+    df["abc"] = "C"
+    for label, limit in reversed(ABC_LIMITS[:-1]):
+        df.loc[start < limit - 1e-12, "abc"] = label
+    return df[["code", "desc", "unit", "qty", "unit_price", value, "share", "cum_share", "abc"]]
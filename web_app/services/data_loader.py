@@ -1,7 +1,19 @@
 import pandas as pd
 import numpy as np
 from pathlib import Path
+from openpyxl.utils import get_column_letter
+import copy
 import math
+import time
+from collections import defaultdict
+from .workbook_cache import read_excel_cached
+from .ingestion import parse_po, parse_price_sheet, parse_analitico
+from .pricing_engine import PricingEngine, build_groups, GROUPS, GROUP_FIELDS, OUT
+from .sparse_pricing import SparseCostModel
+from .usage_index import UsageIndex
+from .bom import BomExplosion
+from .json_payload import Payload, dumps
+from .grid_rows import GridRows
 
 class OrcamentoService:
     def __init__(self, po_file="PO.xlsx", sinapi_file="SINAPI_Referência_2024_08.xlsx"):
@@ -12,8 +24,21 @@ class OrcamentoService:
         self.comp_map = {} # parent -> list of {code, coef}
         self.po_prices = {} # code -> price from PO
         self.calculated_prices = {} # code -> calculated price
-        self.composition_details = {} # code -> list of components
+        self.composition_details = {} # code -> list of components (sanitised, never mutated)
+        self.composition_json = {} # code -> composition_details[code] serialised
+        self.rows_by_code = {} # code -> positions in po_items (a code repeats across idx)
+        self.insumo_classes = {} # code -> ISD classification text
+        self.price_sources = {} # code -> "ISD!AE" sheet/column the loaded price came from
+        self.engine = None # PricingEngine built from comp_map
+        self.sparse_model = None # SparseCostModel, built on first what-if
+        self.usage_index = None # UsageIndex: insumo -> where it is used / how much the obra consumes
+        self.bom = None # BomExplosion over the calculated compositions (curva ABC)
+        self._base_vector = None
+        self._grid_payload = None # Payload of po_items, dropped whenever a price changes
+        self._grid_rows = None # GridRows over po_items (sorted/filtered pages), same lifetime
         self.is_loaded = False
+        # Where load_and_calculate is (it runs in a background thread, see main.lifespan)
+        self.status = {"state": "idle", "stage": None, "started": None, "finished": None, "error": None}
 
     def normalize_val(self, v):
         if pd.isna(v): return None
@@ -33,82 +58,51 @@ class OrcamentoService:
             return data
         return data
 
+    def _stage(self, stage):
+        print(f"{stage}...")
+        self.status["stage"] = stage
+
     def load_and_calculate(self):
-        print("Loading PO items...")
-        self._load_po()
-        print("Loading SINAPI...")
-        self._load_sinapi()
-        print("Calculating...")
-        self._calculate_compositions()
-        self._apply_fallback_logic()
+        self.status.update(state="loading", stage=None, started=time.time(), finished=None, error=None)
+        try:
+            self._stage("Loading PO items")
+            self._load_po()
+            self._stage("Loading SINAPI")
+            self._load_sinapi()
+            self._stage("Calculating")
+            self._calculate_compositions()
+            self._apply_fallback_logic()
+            self._stage("Building indexes")
+            self.usage_index = UsageIndex(self.engine, self.po_items)
+            self.bom = BomExplosion({p: self.comp_map[p] for p in self.engine.order})
+            self._grid_payload = Payload(self.po_items)
+        except Exception as e:
+            self.status.update(state="error", finished=time.time(), error=str(e))
+            raise
         self.is_loaded = True
+        self.status.update(state="ready", stage=None, finished=time.time())
         print("Data loaded and calculated.")
 
+    def get_status(self):
+        st = self.status
+        end = st["finished"] or time.time()
+        return {
+            "state": st["state"],
+            "stage": st["stage"],
+            "elapsed": round(end - st["started"], 3) if st["started"] else None,
+            "error": st["error"],
+            "items": len(self.po_items) if self.is_loaded else None,
+        }
+
     def _load_po(self):
         if not Path(self.po_file).exists():
             print(f"PO File not found: {self.po_file}")
             return
 
         # PO.xlsx: Data starts around row 12.
-        df = pd.read_excel(self.po_file, sheet_name="PO", skiprows=12, header=None)
-        
-        for _, row in df.iterrows():
-            po_idx = str(row[0]).strip()
-            if po_idx == 'nan' or po_idx == 'ITEM': continue
-            
-            source = self.normalize_val(row[1])
-            code = self.normalize_val(row[2])
-            desc = row[3]
-            unit = row[4]
-
-            # BDI - Assuming it might be in the sheet or fixed. 
-            # The MVP text says "BDI % (da PO)". 
-            # Looking at PO.xlsx logic in previous script, it didn't explicitly capture BDI column.
-            # I'll check if there's a BDI column later, for now assume 0 or 25% if not found.
-            # Let's assume a standard BDI or look for it.
-            # For this MVP, I'll default to a placeholder if not in row.
-            
-            # Header Detection
-            if not source:
-                item_type = "HEADER"
-                if code and (pd.isna(desc) or str(desc).strip() == ""):
-                    desc = row[2]
-                    code = ""
-            else:
-                item_type = "ITEM"
-            try:
-                qty = float(row[5]) if not pd.isna(row[5]) else 0.0
-            except:
-                qty = 0.0
-            
-            # Capture BDI
-            try:
-                bdi = float(row[12]) if not pd.isna(row[12]) else 0.0
-            except:
-                bdi = 0.0
-
-            # Capture manual price (Col 8 based on inspection)
-            try:
-                p_val = row[8]
-                if isinstance(p_val, str): p_val = p_val.replace(',', '.')
-                p_float = float(p_val)
-            except:
-                p_float = 0.0
-
-            self.po_items.append({
-                "idx": po_idx, 
-                "source": source, 
-                "code": code, 
-                "desc": desc, 
-                "unit": unit,
-                "qty": qty,
-                "manual_price": p_float,
-                "type": item_type,
-                "bdi_percent": bdi
-            })
-            
-            if code and item_type == "ITEM":
-                self.po_prices[code] = p_float
+        df = read_excel_cached(self.po_file, sheet_name="PO", skiprows=12, header=None)
+        # BDI % comes from Col 12 of the PO (0.0 when empty)
+        self.po_items, self.po_prices = parse_po(df)
 
     def _load_sinapi(self):
         if not Path(self.sinapi_file).exists():
@@ -116,190 +110,255 @@ class OrcamentoService:
             return
 
         # Load Prices (ISD & CSD)
-        def load_prices(sheet_name, price_col_idx):
+        def load_prices(sheet_name, price_col_idx, classes=None):
             try:
-                df_x = pd.read_excel(self.sinapi_file, sheet_name=sheet_name, header=None, skiprows=10)
-                for _, row in df_x.iterrows():
-                    raw_c = row[1]
-                    if pd.isna(raw_c): continue
-                    c_x = str(raw_c).strip()
-                    if c_x.endswith('.0'): c_x = c_x[:-2]
-                    
-                    if c_x:
-                        val_float = 0.0
-                        found = False
-                        
-                        # Try primary column
-                        if price_col_idx < len(row):
-                            p_val = row[price_col_idx]
-                            try:
-                                if isinstance(p_val, str): p_val = p_val.replace(',', '.')
-                                val_float = float(p_val)
-                                if val_float > 0: found = True
-                            except:
-                                pass
-                        
-                        # Fallback scan
-                        if not found or val_float == 0:
-                            for idx in range(4, len(row)):
-                                if idx == price_col_idx: continue
-                                try:
-                                    v = row[idx]
-                                    if isinstance(v, (int, float)) and not pd.isna(v) and v > 0:
-                                        val_float = float(v)
-                                        found = True
-                                        break
-                                except:
-                                    pass
-
-                        if found:
-                            self.sinapi_prices[c_x] = val_float
+                df_x = read_excel_cached(self.sinapi_file, sheet_name=sheet_name, header=None, skiprows=10)
+                prices, sheet_classes, sources = parse_price_sheet(df_x, price_col_idx)
+                self.sinapi_prices.update(prices)
+                for code, col in sources.items():
+                    self.price_sources[code] = f"{sheet_name}!{get_column_letter(col + 1)}"
+                if classes is not None:
+                    classes.update(sheet_classes) # Col 0 = Classificação (MATERIAL, MAO DE OBRA...)
             except Exception as e:
                 print(f"Error loading {sheet_name}: {e}")
 
-        load_prices("ISD", 30)
+        load_prices("ISD", 30, self.insumo_classes)
         load_prices("CSD", 54)
 
         # Load Analítico
         try:
-            df = pd.read_excel(self.sinapi_file, sheet_name="Analítico", header=None, skiprows=5)
-            current_comp_calc = None
-            
-            for _, row in df.iterrows():
-                c_comp = self.normalize_val(row[1])
-                if not c_comp: continue
-                
-                tipo = str(row[2]).strip().upper()
-                if tipo in ["NAN", "", "NONE"] or pd.isna(row[2]):
-                    current_comp_calc = c_comp
-                    if current_comp_calc not in self.comp_map:
-                        self.comp_map[current_comp_calc] = []
-                elif current_comp_calc:
-                    r_code = self.normalize_val(row[3])
-                    if not r_code: continue
-                    try:
-                        coef = float(row[6]) if not pd.isna(row[6]) else 0.0
-                    except:
-                        coef = 0.0
-                    
-                    self.comp_map[current_comp_calc].append({
-                        'code': r_code, 
-                        'coef': coef,
-                        'desc': row[4],
-                        'unit': row[5]
-                    })
+            df = read_excel_cached(self.sinapi_file, sheet_name="Analítico", header=None, skiprows=5)
+            self.comp_map = parse_analitico(df)
         except Exception as e:
             print(f"Error loading Analítico: {e}")
 
     def _calculate_compositions(self):
-        # Iterative calculation
-        for i in range(15):
-            added_count = 0
-            for parent, children in self.comp_map.items():
-                if parent in self.sinapi_prices:
-                    continue 
-                
-                total = 0.0
-                ready = True
-                
-                for child in children:
-                    c_code = child['code']
-                    c_coef = child['coef']
-                    
-                    if c_code in self.sinapi_prices:
-                        total += self.sinapi_prices[c_code] * c_coef
-                    else:
-                        if c_code in self.comp_map:
-                            ready = False
-                            break
-                        else:
-                            # Missing input, assume 0
-                            pass
-                
-                if ready:
-                    self.sinapi_prices[parent] = total
-                    added_count += 1
-            
-            if added_count == 0:
-                break
+        # Single topological pass, shared with generate_final_export_v3
+        groups = build_groups(self.comp_map, self.insumo_classes)
+        self.engine = PricingEngine(self.comp_map, self.sinapi_prices, groups)
+        self.engine.calculate(self.sinapi_prices)
+        self.engine.report()
 
     def _apply_fallback_logic(self):
         # Map final prices to PO Items
+        rows_by_code = defaultdict(list)
+        for pos, item in enumerate(self.po_items):
+            self._price_po_item(item)
+            if item['type'] != 'HEADER' and item['code']:
+                rows_by_code[item['code']].append(pos)
+        self.rows_by_code = {code: tuple(rows) for code, rows in rows_by_code.items()}
+
+        # Composition details for the Inspector, for every composition (children too)
+        for code in self.comp_map:
+            self._set_composition_details(code)
+
+    def _price_po_item(self, item):
+        if item['type'] == 'HEADER':
+            item['final_unit_price'] = 0.0
+            item['total_price'] = 0.0
+            item['origin'] = 'HEADER'
+            return
+
+        code = item['code']
+        price = 0.0
+        origin = 'SEM_PREÇO'
+        
+        # 1. Calculated / SINAPI
+        if code in self.sinapi_prices:
+            price = self.sinapi_prices[code]
+            if price > 0:
+                if code in self.comp_map:
+                    origin = 'CALCULADO'
+                else:
+                    origin = 'SINAPI_DIRETO'
+        
+        # 2. Fallback PO Manual
+        if price == 0 and code in self.po_prices:
+            price = self.po_prices[code]
+            if price > 0:
+                origin = 'PO_MANUAL'
+        
+        item['final_unit_price'] = price
+        item['total_price'] = price * item['qty']
+        item['origin'] = origin
+
+        # Per-group unit prices (MAT / MO / EQP / OUT), computed with the price itself
+        split = self.engine.split_price(code, price) if self.engine else {"OUT": price}
+        for group in GROUP_FIELDS:
+            item[GROUP_FIELDS[group]] = split.get(group, 0.0)
+        
+        # BDI Calcs
+        bdi = item.get('bdi_percent', 0.0)
+        item['unit_price_with_bdi'] = price * (1 + bdi)
+        item['total_price_with_bdi'] = item['unit_price_with_bdi'] * item['qty']
+
+    def _build_composition_details(self, code):
+        comps = []
+        for child in self.comp_map[code]:
+            c_price = self.sinapi_prices.get(child['code'], 0.0)
+            comps.append({
+                "code": child['code'],
+                "desc": child['desc'],
+                "unit": child['unit'],
+                "coef": child['coef'],
+                "group": GROUPS[self.engine.groups.get(child['code'], OUT)] if child['code'] not in self.comp_map else "COMP",
+                "unit_price": c_price,
+                "price_source": self.price_sources.get(child['code']),
+                "total": c_price * child['coef'],
+                "has_children": child['code'] in self.comp_map,
+            })
+        return self.sanitize_for_json(comps)
+
+    def _set_composition_details(self, code):
+        # New list each time: responses already handed out keep their own
+        details = self._build_composition_details(code)
+        self.composition_details[code] = details
+        self.composition_json[code] = dumps(details)
+
+    def is_known_code(self, code):
+        # Loaded price (ISD/CSD) or part of the Analítico structure
+        return code in self.sinapi_prices or (self.engine is not None and code in self.engine.row)
+
+    def copy(self):
+        # Copy that update_price can change while readers keep using this one:
+        # everything update_price mutates is copied, the structure is shared
+        svc = copy.copy(self)
+        svc.sinapi_prices = dict(self.sinapi_prices)
+        svc.po_items = [dict(item) for item in self.po_items]
+        svc.composition_details = dict(self.composition_details)
+        svc.composition_json = dict(self.composition_json)
+        svc.status = dict(self.status)
+        svc.engine = copy.copy(self.engine)
+        svc.engine.breakdown = self.engine.breakdown.copy()
+        svc.usage_index = copy.copy(self.usage_index)
+        svc.usage_index.invalidate_prices()
+        return svc
+
+    def update_price(self, code, new_price):
+        # Incremental repricing: only the compositions that (transitively) use
+        # code, and the PO items priced from them, are recalculated.
+        # Changes this service in place: a served snapshot goes through ServiceSnapshots.update_price.
+        if not self.is_known_code(code):
+            raise KeyError(f"Unknown insumo or composition: {code}")
+        old_price = self.sinapi_prices.get(code)
+        self.sinapi_prices[code] = new_price
+        changed = {code: (old_price, new_price)}
+        changed.update(self.engine.recalculate(self.sinapi_prices, code))
+        if self.sparse_model is not None:
+            self._base_vector = self.sparse_model.price_vector(self.sinapi_prices)
+        self.usage_index.invalidate_prices()
+        self._grid_payload = None
+        self._grid_rows = None
+
+        # Inspector tables showing a changed child
+        for parent in {p for c in changed for p in self.engine.parents.get(c, ())}:
+            if parent in self.composition_details:
+                self._set_composition_details(parent)
+
+        items = []
+        total_delta = 0.0
+        total_with_bdi_delta = 0.0
+        # Items of loaded compositions above code keep their price but not their group split
+        resplit = set(changed) | self.engine.split_ancestors(code)
+        for pos in sorted(p for c in resplit for p in self.rows_by_code.get(c, ())):
+            item = self.po_items[pos]
+            before = (item['final_unit_price'], item['total_price'], item['total_price_with_bdi'], item['origin'])
+            self._price_po_item(item)
+            if before[0] == item['final_unit_price'] and before[3] == item['origin']:
+                continue
+            total_delta += item['total_price'] - before[1]
+            total_with_bdi_delta += item['total_price_with_bdi'] - before[2]
+            items.append({
+                "idx": item['idx'],
+                "code": item['code'],
+                "old_unit_price": before[0],
+                "new_unit_price": item['final_unit_price'],
+                "old_origin": before[3],
+                "new_origin": item['origin'],
+                "old_total_with_bdi": before[2],
+                "new_total_with_bdi": item['total_price_with_bdi'],
+            })
+
+        return self.sanitize_for_json({
+            "code": code,
+            "prices": [{"code": c, "old": o, "new": n} for c, (o, n) in changed.items()],
+            "po_items": items,
+            "total_delta": total_delta,
+            "total_with_bdi_delta": total_with_bdi_delta,
+        })
+
+    def simulate_prices(self, overrides):
+        # What-if: reprice every composition with some prices replaced (an overridden
+        # composition is pinned at its new price), without touching the loaded state.
+        if self.sparse_model is None:
+            self.sparse_model = SparseCostModel(self.engine)
+            self._base_vector = self.sparse_model.price_vector(self.sinapi_prices)
+        simulated = self.sparse_model.what_if(self._base_vector, overrides)
+
+        changes = []
         for item in self.po_items:
             if item['type'] == 'HEADER':
-                item['final_unit_price'] = 0.0
-                item['total_price'] = 0.0
-                item['origin'] = 'HEADER'
                 continue
-
             code = item['code']
-            price = 0.0
-            origin = 'SEM_PREÇO'
-            
-            # 1. Calculated / SINAPI
-            if code in self.sinapi_prices:
-                price = self.sinapi_prices[code]
-                if price > 0:
-                    if code in self.comp_map:
-                        origin = 'CALCULADO'
-                    else:
-                        origin = 'SINAPI_DIRETO'
-            
-            # 2. Fallback PO Manual
-            if price == 0 and code in self.po_prices:
-                price = self.po_prices[code]
-                if price > 0:
-                    origin = 'PO_MANUAL'
-            
-            item['final_unit_price'] = price
-            item['total_price'] = price * item['qty']
-            item['origin'] = origin
-            
-            # BDI Calcs
-            bdi = item.get('bdi_percent', 0.0)
-            item['unit_price_with_bdi'] = price * (1 + bdi)
-            item['total_price_with_bdi'] = item['unit_price_with_bdi'] * item['qty']
-
-            # Prepare composition details for Inspector
-            if code in self.comp_map:
-                comps = []
-                for child in self.comp_map[code]:
-                    c_price = self.sinapi_prices.get(child['code'], 0.0)
-                    comps.append({
-                        "code": child['code'],
-                        "desc": child['desc'],
-                        "unit": child['unit'],
-                        "coef": child['coef'],
-                        "unit_price": c_price,
-                        "total": c_price * child['coef']
-                    })
-                self.composition_details[code] = comps
+            if code in overrides:
+                new_price = overrides[code]
+            elif code in simulated:
+                new_price = simulated[code]
+            else:
+                continue
+            if item['origin'] == 'PO_MANUAL' and new_price == 0:
+                continue
+            if abs(new_price - item['final_unit_price']) > 1e-9:
+                changes.append({
+                    "idx": item['idx'],
+                    "code": code,
+                    "unit_price": item['final_unit_price'],
+                    "simulated_unit_price": new_price,
+                    "total_delta": (new_price - item['final_unit_price']) * item['qty'],
+                })
+        return self.sanitize_for_json(changes)
+
+    def get_insumo_usage(self, code):
+        return self.sanitize_for_json(self.usage_index.usage(code, self.sinapi_prices))
+
+    def get_abc_curve(self):
+        # PO lines not priced as calculated compositions (PO_MANUAL, SINAPI_DIRETO...) are
+        # insumos at their own final price, so the curve adds up to the budget
+        def exploded(item):
+            return item['origin'] == 'CALCULADO' and item['code'] in self.bom.structure
+        prices = dict(self.sinapi_prices)
+        for item in self.po_items:
+            if item['type'] != 'HEADER' and not exploded(item):
+                prices[item['code']] = item['final_unit_price']
+        df = self.bom.table(self.po_items, prices, self.usage_index.descs, self.usage_index.units, exploded)
+        return self.sanitize_for_json(df.to_dict('records'))
 
     def get_grid_data(self):
         return self.sanitize_for_json(self.po_items)
 
+    def get_grid_payload(self):
+        # Serialised once per run (and again after an update_price), not per request
+        if self._grid_payload is None:
+            self._grid_payload = Payload(self.po_items)
+        return self._grid_payload
+
+    def get_grid_rows(self, start, end, sort_model=None, filter_model=None, locate_idx=None):
+        # AG Grid infinite row model: one page of po_items under the grid's sort/filter
+        if self._grid_rows is None:
+            self._grid_rows = GridRows(self.po_items)
+        page = self._grid_rows.page(start, end, sort_model, filter_model)
+        if locate_idx is not None:
+            page["rowIndex"] = self._grid_rows.locate("idx", locate_idx, sort_model, filter_model)
+        return page
+
+    def get_item(self, code):
+        # First PO row with this code (None if the PO doesn't have it)
+        rows = self.rows_by_code.get(code)
+        return self.po_items[rows[0]] if rows else None
+
     def get_composition(self, code):
-        # Prefer pre-calculated details if available
-        if code in self.composition_details:
-             details = self.composition_details[code]
-        elif code in self.comp_map:
-            # Generate on the fly if not in PO items but requested via API
-            details = []
-            for child in self.comp_map[code]:
-                c_price = self.sinapi_prices.get(child['code'], 0.0)
-                details.append({
-                    "code": child['code'],
-                    "desc": child['desc'],
-                    "unit": child['unit'],
-                    "coef": child['coef'],
-                    "unit_price": c_price,
-                    "total": c_price * child['coef']
-                })
-        else:
-            return []
+        # Built at load (and rebuilt by update_price); callers must not modify it
+        return self.composition_details.get(code, [])
 
-        # Enhance with has_children flag
-        for d in details:
-            d['has_children'] = d['code'] in self.comp_map
-        
-        return self.sanitize_for_json(details)
+    def get_composition_json(self, code):
+        return self.composition_json.get(code, b"[]")
@@ -0,0 +1,168 @@
+import json
+import math
+from numbers import Number
+
+import numpy as np
+
+from .text_search import NgramIndex, fold_case
+
+# Backend of the AG Grid infinite row model (/api/grid/rows): the page asks
+# for rows startRow..endRow under a sortModel and a filterModel, and gets
+# {"rows": [...], "lastRow": n} back.
+#
+# Every column is turned once into a rank array (equal values, equal rank;
+# blanks first like AG Grid's default comparator), and the row order of each
+# sort model is built from those ranks once and kept. A filter is a boolean
+# mask over the rows, so applying it to a sorted order is a take, not a sort.
+# Scrolling asks for many pages with the same models: the last (sort, filter)
+# result is kept and each page is a slice of it.
+
+
+def _is_blank(v):
+    return v is None or v == "" or (isinstance(v, float) and math.isnan(v))
+
+
+class GridColumn:
+    def __init__(self, values):
+        self.blank = np.array([_is_blank(v) for v in values], dtype=bool)
+        present = [v for v, b in zip(values, self.blank) if not b]
+        self.numeric = all(isinstance(v, Number) and not isinstance(v, bool) for v in present)
+        if self.numeric:
+            self.values = np.array([np.nan if b else float(v) for v, b in zip(values, self.blank)], dtype=float)
+            keys = np.where(self.blank, -np.inf, self.values)
+        else:
+            self.values = np.array(["" if b else str(v) for v, b in zip(values, self.blank)], dtype=object)
+            keys = self.values
+        # Dense rank, blanks lowest ("" / -inf sort first)
+        _, self.rank = np.unique(keys, return_inverse=True)
+        self.rank = self.rank.astype(np.int64)
+        self._ngrams = None
+        self._folded = None
+
+    def order(self, descending=False):
+        return np.argsort(-self.rank if descending else self.rank, kind="stable")
+
+    # --- Filters (AG Grid text / number filter models) ---
+
+    def text_mask(self, op, value):
+        if op == "blank":
+            return self.blank.copy()
+        if op == "notBlank":
+            return ~self.blank
+        q = fold_case(value).strip()
+        if op in ("contains", "notContains"):
+            if self._ngrams is None:
+                self._ngrams = NgramIndex(self.values)
+            mask = np.zeros(len(self.values), dtype=bool)
+            mask[self._ngrams.search(q)] = True
+            return mask if op == "contains" else ~mask
+        if self._folded is None:
+            self._folded = np.array([fold_case(v).strip() for v in self.values], dtype=object)
+        if op == "equals":
+            return self._folded == q
+        if op == "notEqual":
+            return self._folded != q
+        if op == "startsWith":
+            return np.array([t.startswith(q) for t in self._folded], dtype=bool)
+        if op == "endsWith":
+            return np.array([t.endswith(q) for t in self._folded], dtype=bool)
+        raise ValueError(f"Unsupported text filter: {op}")
+
+    def number_mask(self, op, value, value_to=None):
+        if op == "blank":
+            return self.blank.copy()
+        if op == "notBlank":
+            return ~self.blank
+        if not self.numeric:
+            raise ValueError("Number filter on a text column")
+        v = self.values
+        with np.errstate(invalid="ignore"):
+            if op == "equals":
+                return v == value
+            if op == "notEqual":
+                return ~(v == value)
+            if op == "lessThan":
+                return v < value
+            if op == "lessThanOrEqual":
+                return v <= value
+            if op == "greaterThan":
+                return v > value
+            if op == "greaterThanOrEqual":
+                return v >= value
+            if op == "inRange":
+                # AG Grid's inRange excludes both ends by default
+                lo, hi = sorted((value, value_to))
+                return (v > lo) & (v < hi)
+        raise ValueError(f"Unsupported number filter: {op}")
+
+
+class GridRows:
+    """Sorted / filtered pages over a list of row dicts (OrcamentoService.po_items)."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.columns = {} # field -> GridColumn, built on first use
+        self._orders = {} # sort key -> row order
+        self._last = None # ((sort key, filter key), row order)
+
+    def column(self, field):
+        if field not in self.columns:
+            self.columns[field] = GridColumn([r.get(field) for r in self.rows])
+        return self.columns[field]
+
+    def sorted_order(self, sort_model):
+        key = tuple((s["colId"], s.get("sort", "asc")) for s in sort_model or ())
+        if key not in self._orders:
+            if not key:
+                order = np.arange(len(self.rows))
+            elif len(key) == 1:
+                order = self.column(key[0][0]).order(key[0][1] == "desc")
+            else:
+                # np.lexsort: last key is the primary one
+                ranks = [-self.column(f).rank if d == "desc" else self.column(f).rank for f, d in reversed(key)]
+                order = np.lexsort(ranks)
+            self._orders[key] = order
+        return self._orders[key]
+
+    def condition_mask(self, field, cond):
+        col = self.column(field)
+        if cond.get("filterType") == "number":
+            return col.number_mask(cond.get("type"), cond.get("filter"), cond.get("filterTo"))
+        return col.text_mask(cond.get("type"), cond.get("filter"))
+
+    def filter_mask(self, filter_model):
+        mask = np.ones(len(self.rows), dtype=bool)
+        for field, model in (filter_model or {}).items():
+            # Two-condition models: "conditions" (AG Grid 29+) or condition1/condition2 (older)
+            conditions = model.get("conditions") or [model[k] for k in ("condition1", "condition2") if k in model]
+            if conditions:
+                masks = [self.condition_mask(field, dict(c, filterType=c.get("filterType", model.get("filterType"))))
+                         for c in conditions]
+                combined = np.logical_or.reduce(masks) if model.get("operator") == "OR" else np.logical_and.reduce(masks)
+            else:
+                combined = self.condition_mask(field, model)
+            mask &= combined
+        return mask
+
+    def order(self, sort_model=None, filter_model=None):
+        """Row positions (into rows) in display order under the given models."""
+        key = (json.dumps(sort_model or [], sort_keys=True), json.dumps(filter_model or {}, sort_keys=True))
+        if self._last is None or self._last[0] != key:
+            order = self.sorted_order(sort_model)
+            if filter_model:
+                order = order[self.filter_mask(filter_model)[order]]
+            self._last = (key, order)
+        return self._last[1]
+
+    def page(self, start, end, sort_model=None, filter_model=None):
+        """{"rows": rows start..end, "lastRow": number of rows after filtering}."""
+        order = self.order(sort_model, filter_model)
+        start = max(int(start), 0)
+        end = max(int(end), start)
+        return {"rows": [self.rows[i] for i in order[start:end]], "lastRow": int(len(order))}
+
+    def locate(self, field, value, sort_model=None, filter_model=None):
+        """Display position of the first row whose field == value (-1 if filtered out)."""
+        order = self.order(sort_model, filter_model)
+        hits = np.flatnonzero(self.column(field).values[order] == value)
+        return int(hits[0]) if len(hits) else -1
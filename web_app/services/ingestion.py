@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+
+# Column-wise parsing of the reference sheets. Each parser takes the frame as
+# read by read_excel_cached(..., header=None) and replaces the old iterrows()
+# loops with vectorised string/numeric operations and boolean masks.
+
+
+def normalize_codes(col):
+    # Vectorised normalize_val: strip, upper, drop the '.0' Excel adds to numeric codes
+    s = col.astype(str).str.strip().str.upper().str.removesuffix('.0')
+    return s.astype(object).where(col.notna() & s.notna() & (s != ''), None)
+
+
+def to_number(col):
+    # float() with ',' accepted as decimal separator; anything else -> NaN
+    num = pd.to_numeric(col, errors='coerce')
+    is_text = col.map(lambda v: isinstance(v, str))
+    if is_text.any():
+        num = num.where(~is_text, pd.to_numeric(col[is_text].str.replace(',', '.'), errors='coerce'))
+    return num.astype(float)
+
+
+def column(df, idx):
+    # Sheets can come narrower than the layout expects: missing column -> all NaN
+    return df[idx] if idx in df.columns else pd.Series(np.nan, index=df.index, dtype=object)
+
+
+def parse_po(df):
+    """PO sheet (read with skiprows=12) -> (po_items, po_prices)."""
+    raw_idx = df[0]
+    idx = raw_idx.astype(str).str.strip()
+    keep = raw_idx.notna() & ~idx.isin(['nan', 'ITEM'])
+    df = df[keep]
+    idx = idx[keep]
+
+    source = normalize_codes(df[1])
+    code = normalize_codes(df[2])
+    desc = df[3].astype(object)
+
+    # Header Detection: no source. Its title usually sits in the code column (Col 2).
+    is_header = source.isna()
+    desc_empty = df[3].isna() | (df[3].astype(str).str.strip() == '')
+    title_in_code = is_header & code.notna() & desc_empty
+    desc = desc.where(~title_in_code, df[2])
+    code = code.where(~title_in_code, "")
+
+    qty = to_number(column(df, 5)).fillna(0.0)
+    # float() semantics: an empty cell stays NaN, text that is not a number becomes 0.0
+    raw_price = column(df, 8)
+    manual_price = to_number(raw_price).where(raw_price.isna(), to_number(raw_price).fillna(0.0))
+    bdi = to_number(column(df, 12)).fillna(0.0)
+    item_type = np.where(is_header, "HEADER", "ITEM")
+
+    po_items = [
+        {
+            "idx": i, "source": s, "code": c, "desc": d, "unit": u,
+            "qty": q, "manual_price": p, "type": t, "bdi_percent": b,
+        }
+        for i, s, c, d, u, q, p, t, b in zip(
+            idx, source, code, desc, df[4], qty, manual_price, item_type, bdi)
+    ]
+
+    priced = ~is_header & code.notna() & (code != "")
+    po_prices = dict(zip(code[priced], manual_price[priced]))
+    return po_items, po_prices
+
+
+def numeric_block(df, start_col):
+    # Cells from start_col on as a float matrix; only real numbers count (text -> NaN)
+    cols = []
+    for c in df.columns[df.columns >= start_col]:
+        col = df[c]
+        if col.dtype == object or pd.api.types.is_string_dtype(col):
+            col = col.where(col.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)))
+        cols.append(pd.to_numeric(col, errors='coerce').to_numpy(dtype=float))
+    if not cols:
+        return np.empty((len(df), 0))
+    return np.column_stack(cols)
+
+
+def parse_price_sheet(df, price_col, start_col=4):
+    """ISD / CSD sheet (read with skiprows=10) -> (prices, classifications, sources).
+
+    Code is Col 1, classification Col 0. The price comes from price_col; when
+    that cell is empty or zero the first positive number of the row (from
+    start_col on) is used instead (old patch_prices logic). sources maps each
+    priced code to the sheet column its price was taken from.
+    """
+    codes = normalize_codes(df[1])
+    has_code = codes.notna()
+    classes = dict(zip(codes[has_code], df[0][has_code]))
+
+    primary = to_number(column(df, price_col)).to_numpy()
+    price = np.where(primary > 0, primary, np.nan)
+    source = np.where(primary > 0, price_col, -1)
+
+    # Fallback scan: first positive value per row, primary column excluded
+    block = numeric_block(df, start_col)
+    if block.shape[1]:
+        if 0 <= price_col - start_col < block.shape[1]:
+            block[:, price_col - start_col] = np.nan
+        positive = block > 0
+        first = positive.argmax(axis=1)
+        use = np.isnan(price) & positive.any(axis=1)
+        price = np.where(use, block[np.arange(len(block)), first], price)
+        source = np.where(use, first + start_col, source)
+
+    found = has_code.to_numpy() & ~np.isnan(price)
+    prices = dict(zip(codes[found], price[found].tolist()))
+    sources = dict(zip(codes[found], source[found].tolist()))
+    return prices, classes, sources
+
+
+def parse_analitico(df):
+    """Analítico sheet (read with skiprows=5) -> comp_map: parent -> [{code, coef, tipo, desc, unit}]."""
+    comp = normalize_codes(df[1])
+    tipo_raw = df[2]
+    tipo = tipo_raw.astype(str).str.strip().str.upper()
+
+    # Composition header: code present and empty 'tipo'
+    is_header = comp.notna() & (tipo_raw.isna() | tipo.isin(["NAN", "", "NONE"]))
+    current = comp.where(is_header).ffill()
+    item_code = normalize_codes(df[3])
+    is_item = comp.notna() & ~is_header & current.notna() & item_code.notna()
+    coef = pd.to_numeric(df[6], errors='coerce').fillna(0.0).astype(float)
+
+    comp_map = {c: [] for c in comp[is_header]}
+    for parent, code, c, t, d, u in zip(current[is_item], item_code[is_item], coef[is_item],
+                                        tipo_raw[is_item], df[4][is_item], df[5][is_item]):
+        comp_map[parent].append({'code': code, 'coef': c, 'tipo': t, 'desc': d, 'unit': u})
+    return comp_map
+
+
+def parse_cdhu(df):
+    """CDHU 'Composição' sheet -> one row per composition item, with its parent_code."""
+    c1 = normalize_codes(df[0])
+    # Header rows (services and their groups) have no coefficient
+    is_header = c1.notna() & df[3].isna()
+    current = c1.where(is_header).ffill()
+    is_item = c1.notna() & df[3].notna() & current.notna()
+
+    return pd.DataFrame({
+        "parent_code": current[is_item],
+        "src": "CDHU",
+        "res_code": c1[is_item],
+        "res_desc": df[1][is_item],
+        "res_unit": df[2][is_item],
+        "coef": df[3][is_item],
+        "price": column(df, 4)[is_item],
+    }).reset_index(drop=True)
@@ -0,0 +1,55 @@
+import gzip
+import hashlib
+import json
+import math
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError: # optional: the json module gives the same bytes, only slower
+    orjson = None
+
+# Responses that only change when the data is recalculated (the grid, the EAP)
+# are serialised once into bytes, gzipped once, and served with a strong ETag
+# so an unchanged reload is answered with 304 and no work at all.
+GZIP_LEVEL = 6
+
+
+def _clean(data):
+    # NaN / Infinity -> None, numpy scalars -> Python (what the json module needs)
+    if isinstance(data, list):
+        return [_clean(i) for i in data]
+    if isinstance(data, dict):
+        return {k: _clean(v) for k, v in data.items()}
+    if isinstance(data, np.generic):
+        data = data.item()
+    if isinstance(data, float) and (math.isnan(data) or math.isinf(data)):
+        return None
+    return data
+
+
+def dumps(data):
+    """JSON bytes of data, NaN/Infinity written as null."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(_clean(data), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class Payload:
+    """A serialised JSON response: body, gzip body and their ETags."""
+
+    def __init__(self, data):
+        self.body = dumps(data)
+        self.gzip_body = gzip.compress(self.body, compresslevel=GZIP_LEVEL, mtime=0)
+        digest = hashlib.sha1(self.body).hexdigest()
+        # One strong ETag per representation (identity / gzip)
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gz"'
+
+    def matches(self, if_none_match):
+        # If-None-Match uses the weak comparison: W/ prefixes are ignored
+        if not if_none_match:
+            return False
+        tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+        return "*" in tags or self.etag in tags or self.gzip_etag in tags
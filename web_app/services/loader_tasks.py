@@ -0,0 +1,161 @@
+import io
+import multiprocessing as mp
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, redirect_stdout
+
+from .ingestion import parse_po, parse_price_sheet, parse_analitico, parse_cdhu
+from .sicro_costing import price_sicro_blocks
+from .sicro_parser import iter_sicro_blocks
+from .workbook_cache import read_excel_cached
+
+# Loader stage of generate_final_export_v3: one task per input workbook, all
+# side by side in a process pool. Each returns plain dicts / DataFrames (cheap
+# to pickle) and the merge only starts when all of them are back. The SICRO
+# task only keeps the compositions the PO needs, which are known once the PO
+# and SINAPI tasks are done: the caller sends them on a feed (task_feed) while
+# the report is being read. What a task prints is captured and handed back as
+# its log, so the caller prints it in a stable order.
+MAX_WORKERS = 4
+
+
+def parse_po_task(path):
+    print(f"Loading PO items from {path}...")
+    # PO.xlsx: Data starts around row 12.
+    df = read_excel_cached(path, sheet_name="PO", skiprows=12, header=None)
+    po_items, po_prices = parse_po(df) # po_prices: code -> price
+    return {"po_items": po_items, "po_prices": po_prices}
+
+
+def parse_sinapi_task(path):
+    print(f"Loading SINAPI Prices from {path} (ISD & CSD)...")
+    prices = {}
+    classes = {} # code -> ISD classification, for the MAT/MO/EQP/OUT split
+    sources = {} # code -> (sheet, column index, fallback?) the loaded price came from
+
+    # Code=Col 1 (Index 1). Price (SP)=Col 30 (ISD) and Col 54 (CSD).
+    for sheet_name, price_col_idx in (("ISD", 30), ("CSD", 54)):
+        try:
+            # Skip 10 rows (Headers are in first 10 rows, data starts row 10)
+            df = read_excel_cached(path, sheet_name=sheet_name, header=None, skiprows=10)
+            sheet_prices, sheet_classes, sheet_sources = parse_price_sheet(df, price_col_idx)
+            prices.update(sheet_prices)
+            for code, col in sheet_sources.items():
+                sources[code] = (sheet_name, col, col != price_col_idx)
+            if sheet_name == "ISD":
+                classes.update(sheet_classes) # Col 0 = Classificação (MATERIAL, MAO DE OBRA...)
+            print(f"Loaded {len(sheet_prices)} items from {sheet_name}")
+        except Exception as e:
+            print(f"Error loading {sheet_name}: {e}")
+    print(f"Total prices loaded: {len(prices)}")
+
+    print(f"Parsing {path} (Analítico)...")
+    df = read_excel_cached(path, sheet_name="Analítico", header=None, skiprows=5)
+    # Dependency map: parent -> list of {code, coef, tipo, desc, unit}
+    comp_map = parse_analitico(df)
+    print(f"Mapped {len(comp_map)} compositions.")
+    return {"prices": prices, "classes": classes, "sources": sources, "comp_map": comp_map}
+
+
+def parse_cdhu_task(path):
+    print(f"Parsing {path}...")
+    df = read_excel_cached(path, sheet_name="Composição", header=None)
+    return {"items": parse_cdhu(df)}
+
+
+class PendingCodes:
+    """Codes to keep, arriving on a feed while the file is read.
+
+    Until they arrive every composition is kept (filtered afterwards); from
+    then on the others are skipped while reading.
+    """
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.codes = None
+
+    def __contains__(self, code):
+        if self.codes is None:
+            try:
+                self.codes = self.feed.get_nowait()
+            except queue.Empty:
+                return True
+        return code in self.codes
+
+    def wait(self):
+        if self.codes is None:
+            self.codes = self.feed.get()
+        return self.codes
+
+
+def parse_sicro_task(path, feed):
+    # feed: gets the set of required codes (PO codes and their SINAPI sub-compositions)
+    print(f"Streaming {path} (200k rows, only required compositions are kept)...")
+    required = PendingCodes(feed)
+    blocks = list(iter_sicro_blocks(path, required))
+    codes = required.wait()
+    prices, items = price_sicro_blocks(b for b in blocks if b["code"] in codes)
+    print(f"Priced {len(prices)} SICRO compositions (production method).")
+    return {"prices": prices, "items": items}
+
+
+def _watch_parent():
+    # Pool initializer: a worker goes away with the process that started it
+    # (e.g. a recalculation cancelled from the visualiser kills only that one)
+    parent = mp.parent_process()
+    if parent is not None:
+        def watch():
+            parent.join()
+            os._exit(1)
+        threading.Thread(target=watch, daemon=True).start()
+
+
+def _run(task, args):
+    out = io.StringIO()
+    with redirect_stdout(out):
+        result = task(*args)
+    result["log"] = out.getvalue()
+    return result
+
+
+@contextmanager
+def task_feed():
+    """Queue a running task can wait on for a value the caller only knows later."""
+    with mp.get_context("spawn").Manager() as manager:
+        yield manager.Queue()
+
+
+def run_tasks(tasks, max_workers=MAX_WORKERS, on_done=None):
+    """Run {name: (task, args)} and return {name: result} once all have finished.
+
+    Results carry the task's printed output under "log". on_done(name, result)
+    is called in the caller's process as each task finishes; a task waiting on
+    a task_feed must come after the tasks its value depends on. Falls back to
+    running the tasks one after the other where a pool can't be started
+    (daemon process, single task).
+    """
+    if len(tasks) < 2 or mp.current_process().daemon:
+        results = {}
+        for name, (task, args) in tasks.items():
+            results[name] = _run(task, args)
+            if on_done:
+                on_done(name, results[name])
+        return results
+    workers = min(max_workers, len(tasks), os.cpu_count() or 1)
+    pool = ProcessPoolExecutor(workers, mp_context=mp.get_context("spawn"), initializer=_watch_parent)
+    try:
+        futures = {pool.submit(_run, task, args): name for name, (task, args) in tasks.items()}
+        results = {}
+        for f in as_completed(futures):
+            name = futures[f]
+            results[name] = f.result()
+            if on_done:
+                on_done(name, results[name])
+    except BaseException:
+        # Don't wait for the others: one may be waiting on a feed this failure never fills
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+    return {name: results[name] for name in tasks}
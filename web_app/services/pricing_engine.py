@@ -0,0 +1,281 @@
+from collections import deque
+import unicodedata
+
+import numpy as np
+
+# Cost groups carried next to every price (manual: "OBS MUITO IMPORTANTE")
+GROUPS = ("MAT", "MO", "EQP", "OUT")
+MAT, MO, EQP, OUT = range(len(GROUPS))
+# Grid / export column holding each group's share of the unit price
+GROUP_FIELDS = {"MAT": "price_mat", "MO": "price_mo", "EQP": "price_eqp", "OUT": "price_out"}
+
+
+def classify_insumo(text):
+    # ISD "Classificação" / Analítico "tipo" text -> group index
+    if text is None or (isinstance(text, float) and np.isnan(text)):
+        return OUT
+    s = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode().upper()
+    if "MAO DE OBRA" in s:
+        return MO
+    if "EQUIPAMENTO" in s:
+        return EQP
+    if "MATERIA" in s:
+        return MAT
+    return OUT
+
+
+def build_groups(comp_map, classifications):
+    """code -> group index: ISD classification first, Analítico child 'tipo' otherwise."""
+    groups = {}
+    for children in comp_map.values():
+        for child in children:
+            if child['code'] not in groups:
+                groups[child['code']] = classify_insumo(child.get('tipo'))
+    for code, text in classifications.items():
+        g = classify_insumo(text)
+        if g != OUT or code not in groups:
+            groups[code] = g
+    return groups
+
+
+
+class PricingEngine:
+    """Prices every composition of comp_map in one topological pass.
+
+    comp_map is parent -> list of {'code', 'coef', ...} (Analítico structure).
+    Codes present in known_prices (ISD/CSD) are treated as leaves, exactly like
+    the old fixed-point loop: a composition with a loaded price is not recalculated.
+
+    Next to the scalar price every code carries a row of self.breakdown with
+    its cost per group (GROUPS). Leaves put their whole price in their group
+    (groups: code -> index, OUT when unknown); compositions get the
+    coefficient-weighted sum of their children's rows in the same pass.
+    Compositions with a loaded price are split like their children too,
+    scaled to the loaded price (own group when the children cost nothing).
+    """
+
+    def __init__(self, comp_map, known_prices, groups=None):
+        self.comp_map = comp_map
+        self.groups = groups or {}
+        self.parents = {}        # child -> set of parents (reverse index, every edge)
+        self.order = []          # compositions to calculate, children before parents
+        self.cycles = []         # lists of codes that depend on each other
+        self.unresolved = set()  # compositions that can never be priced (cycle or fed by one)
+        self.position = {}       # code -> index in self.order
+        self.split_order = []    # compositions whose breakdown comes from their children (loaded too)
+        self.split_position = {} # code -> index in self.split_order
+        self.row = {}            # code -> row of self.breakdown
+        self.breakdown = None    # len(row) x len(GROUPS)
+        self._children = {}      # parent -> (child rows, coefficients) as arrays
+        self._build(known_prices)
+
+    def _build(self, known_prices):
+        for parent, children in self.comp_map.items():
+            for child in children:
+                self.parents.setdefault(child['code'], set()).add(parent)
+
+        pending = [p for p in self.comp_map if p not in known_prices]
+        pending_set = set(pending)
+
+        # Kahn: count, for each pending composition, the pending sub-compositions it still waits for
+        waiting = {}
+        for parent in pending:
+            waiting[parent] = len({c['code'] for c in self.comp_map[parent] if c['code'] in pending_set})
+
+        queue = deque(p for p in pending if waiting[p] == 0)
+        while queue:
+            node = queue.popleft()
+            self.order.append(node)
+            for parent in self.parents.get(node, ()):
+                if parent in waiting:
+                    waiting[parent] -= 1
+                    if waiting[parent] == 0:
+                        queue.append(parent)
+
+        self.position = {code: i for i, code in enumerate(self.order)}
+        self.unresolved = pending_set.difference(self.order)
+
+        # Same pass over every composition, loaded ones included, for the breakdown.
+        # Calculated compositions only reachable through a cycle of loaded ones
+        # follow in pricing order (their loaded children keep a plain leaf row).
+        waiting = {p: len({c['code'] for c in children if c['code'] in self.comp_map})
+                   for p, children in self.comp_map.items()}
+        queue = deque(p for p, n in waiting.items() if n == 0)
+        while queue:
+            node = queue.popleft()
+            self.split_order.append(node)
+            for parent in self.parents.get(node, ()):
+                if parent in waiting:
+                    waiting[parent] -= 1
+                    if waiting[parent] == 0:
+                        queue.append(parent)
+        placed = set(self.split_order)
+        self.split_order += [p for p in self.order if p not in placed]
+        self.split_position = {code: i for i, code in enumerate(self.split_order)}
+
+        for code in self.comp_map:
+            self.row.setdefault(code, len(self.row))
+        for children in self.comp_map.values():
+            for child in children:
+                self.row.setdefault(child['code'], len(self.row))
+        self.breakdown = np.zeros((len(self.row), len(GROUPS)))
+        for parent in self.split_order:
+            children = self.comp_map[parent]
+            self._children[parent] = (
+                np.array([self.row[c['code']] for c in children], dtype=np.int64),
+                np.array([c['coef'] for c in children], dtype=float),
+            )
+        if self.unresolved:
+            self.cycles = self._find_cycles(self.unresolved)
+
+    def _find_cycles(self, nodes):
+        # Tarjan SCC (iterative) restricted to the unresolved sub-graph
+        index = {}
+        low = {}
+        on_stack = set()
+        stack = []
+        cycles = []
+        counter = 0
+
+        def successors(n):
+            return [c['code'] for c in self.comp_map.get(n, []) if c['code'] in nodes]
+
+        for root in sorted(nodes):
+            if root in index:
+                continue
+            work = [(root, iter(successors(root)))]
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, it = work[-1]
+                advanced = False
+                for succ in it:
+                    if succ not in index:
+                        index[succ] = low[succ] = counter
+                        counter += 1
+                        stack.append(succ)
+                        on_stack.add(succ)
+                        work.append((succ, iter(successors(succ))))
+                        advanced = True
+                        break
+                    elif succ in on_stack:
+                        low[node] = min(low[node], index[succ])
+                if advanced:
+                    continue
+                work.pop()
+                if work:
+                    low[work[-1][0]] = min(low[work[-1][0]], low[node])
+                if low[node] == index[node]:
+                    scc = []
+                    while True:
+                        n = stack.pop()
+                        on_stack.discard(n)
+                        scc.append(n)
+                        if n == node:
+                            break
+                    if len(scc) > 1 or node in successors(node):
+                        cycles.append(sorted(scc))
+        return cycles
+
+    def calculate(self, prices):
+        """Fill prices (code -> unit price) with every composition in self.order."""
+        bd = self.breakdown
+        bd[:] = 0.0
+        for code, r in self.row.items():
+            if code not in self.position:
+                bd[r, self.groups.get(code, OUT)] = prices.get(code, 0.0)
+
+        for parent in self.split_order:
+            self._update(parent, prices)
+        return prices
+
+    def _update(self, parent, prices):
+        # Price (calculated compositions) and breakdown row of one composition
+        rows, coefs = self._children[parent]
+        vec = coefs @ self.breakdown[rows]
+        r = self.row[parent]
+        if parent in self.position:
+            total = 0.0
+            for child in self.comp_map[parent]:
+                total += prices.get(child['code'], 0.0) * child['coef']
+            prices[parent] = total
+            self.breakdown[r] = vec
+            return total
+        # Loaded price: the children's split scaled to it
+        price = prices.get(parent, 0.0)
+        cost = vec.sum()
+        self.breakdown[r] = 0.0
+        if cost > 0:
+            self.breakdown[r] = vec * (price / cost)
+        else:
+            self.breakdown[r, self.groups.get(parent, OUT)] = price
+        return price
+
+    def ancestors(self, code):
+        """Calculated compositions that use code directly or through sub-compositions."""
+        found = set()
+        stack = [code]
+        while stack:
+            node = stack.pop()
+            for parent in self.parents.get(node, ()):
+                # Loaded (ISD/CSD) or unresolved parents are not recalculated: stop there
+                if parent in self.position and parent not in found:
+                    found.add(parent)
+                    stack.append(parent)
+        return found
+
+    def split_ancestors(self, code):
+        """Compositions whose breakdown depends on code (through loaded ones too)."""
+        found = set()
+        stack = [code]
+        while stack:
+            node = stack.pop()
+            for parent in self.parents.get(node, ()):
+                if parent in self.split_position and parent not in found:
+                    found.add(parent)
+                    stack.append(parent)
+        return found
+
+    def recalculate(self, prices, code):
+        """Recompute only what depends on code. Returns {code: (old, new)} of changed prices."""
+        changed = {}
+        bd = self.breakdown
+        if code in self.row and code not in self.position:
+            bd[self.row[code]] = 0.0
+            bd[self.row[code], self.groups.get(code, OUT)] = prices.get(code, 0.0)
+
+        # Loaded compositions above code keep their price but get a new split
+        todo = self.split_ancestors(code)
+        if code in self.split_position and code not in self.position:
+            todo.add(code)
+        for parent in sorted(todo, key=self.split_position.__getitem__):
+            old = prices.get(parent)
+            total = self._update(parent, prices)
+            if parent in self.position and old != total:
+                changed[parent] = (old, total)
+        return changed
+
+    def split_price(self, code, price):
+        """Per-group split of price for code: the computed breakdown when it adds up to
+        price, the code's own group for a plain insumo, OUT otherwise (PO manual prices)."""
+        r = self.row.get(code)
+        if r is not None:
+            vec = self.breakdown[r]
+            if abs(vec.sum() - price) <= 1e-6 * max(1.0, abs(price)):
+                return dict(zip(GROUPS, vec.tolist()))
+        split = dict.fromkeys(GROUPS, 0.0)
+        split[GROUPS[self.groups.get(code, OUT) if r is None else OUT]] = price
+        return split
+
+    def report(self):
+        print(f"Priced {len(self.order)} compositions in topological order.")
+        for cycle in self.cycles:
+            print(f"CYCLE: {' -> '.join(cycle)}")
+        if self.unresolved:
+            in_cycles = {c for cycle in self.cycles for c in cycle}
+            blocked = sorted(self.unresolved - in_cycles)
+            print(f"Unresolved compositions: {len(self.unresolved)} ({len(in_cycles)} in cycles, {len(blocked)} depend on a cycle)")
+            if blocked:
+                print(f"  Depend on a cycle: {', '.join(blocked[:20])}{' ...' if len(blocked) > 20 else ''}")
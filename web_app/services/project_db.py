@@ -0,0 +1,192 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from queue import Empty, Full, LifoQueue
+
+import pandas as pd
+
+# dados/projeto.sqlite: cotações, validações and the composition / insumo libraries.
+# Every script goes through this module instead of opening the file itself.
+DB_PATH = Path("dados/projeto.sqlite")
+POOL_SIZE = 4
+MMAP_SIZE = 256 * 1024 * 1024
+
+# (table, column) lookups that must not be full-table reads
+INDEXES = (
+    ("validacoes_cot", "po_item"),
+    ("validacoes_cot", "codigo"),
+    ("cotacoes_aba", "codigo"),
+    ("composicoes", "codigo"),
+    ("insumos_unificados", "codigo"),
+    ("composicoes_analiticas_analisadas_unitaria", "codigo_composicao"),
+)
+
+# SQLite's default limit on "?" parameters is 999 on older builds
+IN_CHUNK = 500
+
+_pools = {}
+_prepared = set()
+_lock = threading.Lock()
+
+
+def _open(path):
+    # mode=rw: never creates the file (a missing DB must not turn into an empty one)
+    conn = sqlite3.connect(f"{Path(path).as_uri()}?mode=rw", uri=True, check_same_thread=False)
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA query_only=1")
+    return conn
+
+
+def _prepare(path):
+    # First use of a database file: WAL journal and the lookup indexes
+    conn = sqlite3.connect(f"{Path(path).as_uri()}?mode=rw", uri=True)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        for table, column in INDEXES:
+            cols = [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+            if column in cols:
+                conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table}({column})")
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        # Read-only copy of the database: queries still work, just without the indexes
+        print(f"Could not prepare {path}: {e}")
+    finally:
+        conn.close()
+
+
+@contextmanager
+def connection(db_path=DB_PATH):
+    """Read connection from the pool of db_path, returned to it afterwards."""
+    path = str(Path(db_path).resolve())
+    if not Path(path).exists():
+        raise FileNotFoundError(f"DB not found: {db_path}")
+    with _lock:
+        if path not in _prepared:
+            _prepare(path)
+            _prepared.add(path)
+        pool = _pools.setdefault(path, LifoQueue(maxsize=POOL_SIZE))
+    try:
+        conn = pool.get_nowait()
+    except Empty:
+        conn = _open(path)
+    try:
+        yield conn
+    finally:
+        try:
+            pool.put_nowait(conn)
+        except Full:
+            conn.close()
+
+
+def close_all():
+    with _lock:
+        for pool in _pools.values():
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except Empty:
+                    break
+        _pools.clear()
+
+
+def to_number_br(col):
+    # Numbers stored as text in pt-BR ("1.234,56", "R$ 12,5") or as plain numbers -> float
+    num = pd.to_numeric(col, errors='coerce')
+    text = col.map(lambda v: isinstance(v, str))
+    if text.any():
+        s = col[text].str.strip().str.replace(r'^R\$\s*', '', regex=True)
+        comma = s.str.contains(',', regex=False)
+        s = s.where(~comma, s.str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+        num = num.where(~text, pd.to_numeric(s, errors='coerce'))
+    bad = col.notna() & num.isna()
+    if bad.any():
+        print(f"{bad.sum()} values of {col.name} are not numbers (e.g. {col[bad].iloc[0]!r})")
+    return num.astype(float)
+
+
+def _query(sql, params=(), db_path=DB_PATH, numeric=()):
+    with connection(db_path) as conn:
+        df = pd.read_sql_query(sql, conn, params=params)
+    for col in numeric:
+        df[col] = to_number_br(df[col])
+    return df
+
+
+# --- Schema ---
+
+def table_names(db_path=DB_PATH):
+    with connection(db_path) as conn:
+        return [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+
+
+def table_columns(table, db_path=DB_PATH):
+    # [(name, declared type)]
+    with connection(db_path) as conn:
+        return [(r[1], r[2]) for r in conn.execute(f"PRAGMA table_info({table})")]
+
+
+# --- Cotações ---
+
+def validacoes_cot(db_path=DB_PATH):
+    # po_item (PO idx, text) -> codigo of the validated cotação
+    return _query("SELECT po_item, codigo FROM validacoes_cot", db_path=db_path)
+
+
+def cotacoes_aba(codes=None, db_path=DB_PATH):
+    # codigo, descricao, valor_material (float); only the given codes when codes is set
+    sql = "SELECT codigo, descricao, valor_material FROM cotacoes_aba"
+    if codes is None:
+        return _query(sql, db_path=db_path, numeric=["valor_material"])
+    codes = list(dict.fromkeys(codes))
+    parts = [
+        _query(f"{sql} WHERE codigo IN ({','.join('?' * len(chunk))})", chunk, db_path, ["valor_material"])
+        for chunk in (codes[i:i + IN_CHUNK] for i in range(0, len(codes), IN_CHUNK))
+    ]
+    return pd.concat(parts, ignore_index=True) if parts else _query(f"{sql} WHERE 0", db_path=db_path)
+
+
+def cotacoes_for_po_items(po_items, db_path=DB_PATH):
+    """Validated cotação of each PO idx: po_item, codigo, descricao, valor_material.
+
+    When a PO item was validated more than once the last validation counts
+    (and yields nothing if that code has no cotação), as the old dict-based
+    lookup did.
+    """
+    po_items = list(dict.fromkeys(po_items))
+    sql = """
+        SELECT v.po_item, v.codigo, c.codigo AS found, c.descricao, c.valor_material
+        FROM validacoes_cot v LEFT JOIN cotacoes_aba c ON c.codigo = v.codigo
+        WHERE v.po_item IN ({}) ORDER BY v.rowid, c.rowid
+    """
+    parts = [
+        _query(sql.format(','.join('?' * len(chunk))), chunk, db_path, ["valor_material"])
+        for chunk in (po_items[i:i + IN_CHUNK] for i in range(0, len(po_items), IN_CHUNK))
+    ]
+    if not parts:
+        return pd.DataFrame(columns=["po_item", "codigo", "descricao", "valor_material"])
+    df = pd.concat(parts, ignore_index=True)
+    # Last validation per item, and for a duplicated cotação code the last row (dict semantics)
+    df = df.drop_duplicates("po_item", keep="last")
+    df = df[df["found"].notna()]
+    return df[["po_item", "codigo", "descricao", "valor_material"]].reset_index(drop=True)
+
+
+# --- Composition / insumo libraries ---
+
+def composicoes(db_path=DB_PATH):
+    return _query("SELECT fonte, codigo, descricao, unidade FROM composicoes", db_path=db_path)
+
+
+def insumos_unificados(db_path=DB_PATH):
+    return _query(
+        "SELECT fonte, codigo, descricao, unidade, preco_unitario FROM insumos_unificados",
+        db_path=db_path, numeric=["preco_unitario"])
+
+
+def composicoes_analiticas(db_path=DB_PATH):
+    # One row per analysed composition (the table has one row per composition item)
+    return _query(
+        "SELECT codigo_composicao as codigo, descricao, fonte_composicao as fonte "
+        "FROM composicoes_analiticas_analisadas_unitaria GROUP BY codigo_composicao",
+        db_path=db_path)
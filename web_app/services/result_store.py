@@ -0,0 +1,159 @@
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from .pricing_engine import GROUPS, GROUP_FIELDS
+
+# Computed budget of the last run (what tabela_servicos_export.csv and
+# tabela_insumos_export.csv hold), kept in tables keyed by service / composition
+# so a rerun can compare row by row. Every row carries the
+# run that last changed it; a rerun only rewrites the rows whose content changed.
+STORE_PATH = Path("dados/resultados.sqlite")
+
+SERVICO_COLUMNS = [
+    "idx", "source", "code", "desc", "unit", "qty", "manual_price", "type", "bdi_percent",
+    "status", "final_price", "method", "price_mat", "price_mo", "price_eqp", "price_out",
+]
+INSUMO_COLUMNS = ["parent_code", "src", "res_code", "res_desc", "res_unit", "coef", "price"]
+TOTAL_COLUMNS = ["idx", "total"] + [GROUP_FIELDS[g] for g in GROUPS]
+
+# table -> (key columns, value columns, extra indexed columns)
+TABLES = {
+    "servicos": (["idx", "seq"], ["pos"] + SERVICO_COLUMNS[1:], ["code"]),
+    "insumos": (["parent_code", "seq"], INSUMO_COLUMNS[1:], ["res_code"]),
+    "group_totals": (["idx"], TOTAL_COLUMNS[1:], []),
+}
+
+
+def _connect(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for table, (keys, values, indexed) in TABLES.items():
+        cols = ", ".join(f'"{c}"' for c in keys + values)
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {table} ({cols}, row_hash TEXT, run_id INTEGER, '
+            f'PRIMARY KEY ({", ".join(keys)}))')
+        for col in indexed + ["run_id"]:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_{col} ON {table}("{col}")')
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "created_at TEXT, servicos INTEGER, insumos INTEGER, total REAL, changed INTEGER)")
+    return conn
+
+
+def group_totals(servicos):
+    """Total and per-group (MAT/MO/EQP/OUT) cost of every EAP level, from the item rows.
+
+    Each item is added to all the prefixes of its idx (1.2.3 -> 1, 1.2), so
+    one groupby gives the subtotal of every header.
+    """
+    items = servicos[servicos["type"] != "HEADER"]
+    qty = pd.to_numeric(items["qty"], errors="coerce").fillna(0.0)
+    values = pd.DataFrame({"total": qty * pd.to_numeric(items["final_price"], errors="coerce").fillna(0.0)})
+    for g in GROUPS:
+        field = GROUP_FIELDS[g]
+        price = pd.to_numeric(items[field], errors="coerce").fillna(0.0) if field in items else 0.0
+        values[field] = qty * price
+
+    parts = items["idx"].astype(str).str.strip().str.split(".")
+    prefixes = parts.map(lambda p: [".".join(p[:n]) for n in range(1, len(p))])
+    values["idx"] = prefixes
+    values = values.explode("idx").dropna(subset=["idx"])
+    return values.groupby("idx", sort=False)[TOTAL_COLUMNS[1:]].sum().reset_index()
+
+
+def _frames(servicos, insumos):
+    servicos = servicos.reindex(columns=SERVICO_COLUMNS).copy()
+    servicos["idx"] = servicos["idx"].astype(str)
+    servicos["seq"] = servicos.groupby("idx").cumcount()
+    servicos["pos"] = np.arange(len(servicos))
+    insumos = insumos.reindex(columns=INSUMO_COLUMNS).copy()
+    insumos["parent_code"] = insumos["parent_code"].astype(str)
+    insumos["seq"] = insumos.groupby("parent_code").cumcount()
+    return {"servicos": servicos, "insumos": insumos, "group_totals": group_totals(servicos)}
+
+
+def _sql_value(v):
+    if v is None or (isinstance(v, float) and np.isnan(v)):
+        return None
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+def _upsert(conn, table, df, run_id):
+    keys, values, _ = TABLES[table]
+    df = df.astype(object)
+    df["row_hash"] = pd.util.hash_pandas_object(df[keys + values], index=False).map("{:016x}".format)
+
+    old = pd.read_sql_query(f"SELECT {', '.join(keys)}, row_hash FROM {table}", conn)
+    key_of = lambda frame: list(zip(*(frame[k].astype(str) for k in keys)))
+    old_hash = dict(zip(key_of(old), old["row_hash"]))
+    new_keys = key_of(df)
+
+    changed = df[[old_hash.get(k) != h for k, h in zip(new_keys, df["row_hash"])]]
+    gone = set(old_hash).difference(new_keys)
+
+    cols = keys + values + ["row_hash"]
+    quoted = ", ".join(f'"{c}"' for c in cols)
+    updates = ", ".join(f'"{c}" = excluded."{c}"' for c in values + ["row_hash", "run_id"])
+    conn.executemany(
+        f'INSERT INTO {table} ({quoted}, run_id) VALUES ({", ".join("?" * (len(cols) + 1))}) '
+        f'ON CONFLICT ({", ".join(keys)}) DO UPDATE SET {updates}',
+        ([_sql_value(v) for v in row] + [run_id] for row in changed[cols].itertuples(index=False)))
+    where = " AND ".join(f'CAST("{k}" AS TEXT) = ?' for k in keys)
+    conn.executemany(f"DELETE FROM {table} WHERE {where}", gone)
+    return len(changed), len(gone)
+
+
+def save_run(servicos, insumos, path=STORE_PATH):
+    """Store a computed budget. Returns (run_id, {table: (rows written, rows deleted)})."""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    frames = _frames(servicos, insumos)
+    stats = {}
+    with closing(_connect(path)) as conn, conn:
+        items = frames["servicos"][frames["servicos"]["type"] != "HEADER"]
+        total = float((pd.to_numeric(items["qty"], errors="coerce") * pd.to_numeric(items["final_price"], errors="coerce")).sum())
+        cur = conn.execute(
+            "INSERT INTO runs (created_at, servicos, insumos, total) VALUES (?, ?, ?, ?)",
+            (datetime.now().isoformat(timespec="seconds"), len(frames["servicos"]), len(frames["insumos"]), total))
+        run_id = cur.lastrowid
+        for table, df in frames.items():
+            stats[table] = _upsert(conn, table, df, run_id)
+        conn.execute("UPDATE runs SET changed = ? WHERE run_id = ?", (sum(w + d for w, d in stats.values()), run_id))
+    return run_id, stats
+
+
+def exists(path=STORE_PATH):
+    return Path(path).exists()
+
+
+def _read(sql, params=(), path=STORE_PATH):
+    with closing(sqlite3.connect(path)) as conn:
+        return pd.read_sql_query(sql, conn, params=params)
+
+
+def latest_run(path=STORE_PATH):
+    df = _read("SELECT * FROM runs ORDER BY run_id DESC LIMIT 1", path=path)
+    return df.iloc[0].to_dict() if len(df) else None
+
+
+def load_servicos(path=STORE_PATH):
+    # Same columns and order as tabela_servicos_export.csv
+    cols = ", ".join(f'"{c}"' for c in SERVICO_COLUMNS)
+    return _read(f"SELECT {cols} FROM servicos ORDER BY pos", path=path)
+
+
+def load_insumos(path=STORE_PATH):
+    # Same columns as tabela_insumos_export.csv, each composition's rows together and in order
+    cols = ", ".join(f'"{c}"' for c in INSUMO_COLUMNS)
+    return _read(f"SELECT {cols} FROM insumos ORDER BY parent_code, seq", path=path)
+
+
+def load_group_totals(path=STORE_PATH):
+    cols = ", ".join(f'"{c}"' for c in TOTAL_COLUMNS)
+    return _read(f"SELECT {cols} FROM group_totals", path=path)
@@ -0,0 +1,160 @@
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+from .sicro_parser import is_empty, is_item_row, normalize_val
+
+# SICRO prices a composition differently from SINAPI (see the manual):
+#   unit cost = (equipment hourly cost + labour hourly cost) / team production
+#               + materials + auxiliary activities + fixed time + transport
+# and an equipment row carries its productive and unproductive cost side by side.
+#
+# Column layout of the analytical report rows:
+#   equipment (A): 0 code, 1 desc, 2 qty, 3 util. operativa, 4 util. improdutiva,
+#                  5 custo operacional operativo, 6 custo operacional improdutivo
+#   other rows:    0 code, 1 desc, 2 qty, 3 unit, 5 unit price / hourly cost
+EQP_COLS = (2, 3, 4, 5, 6)
+QTY_COL, UNIT_COL, PRICE_COL = 2, 3, 5
+
+# Section letter -> kind. Sections are announced by a row like "A - EQUIPAMENTOS".
+SECTIONS = {"A": "EQP", "B": "MO", "C": "MAT", "D": "AUX", "E": "TEMPO_FIXO", "F": "TRANSPORTE"}
+SECTION_KEYWORDS = (
+    ("EQUIPAMENTO", "EQP"), ("MAO DE OBRA", "MO"), ("MATERIA", "MAT"),
+    ("ATIVIDADES AUXILIARES", "AUX"), ("TEMPO FIXO", "TEMPO_FIXO"), ("TRANSPORTE", "TRANSPORTE"),
+)
+_SECTION_RE = re.compile(r"^\s*([A-F])\s*[-–]\s*")
+
+
+def _fold(v):
+    return unicodedata.normalize("NFKD", str(v)).encode("ascii", "ignore").decode().upper()
+
+
+def _num(v):
+    if v is None: return np.nan
+    if isinstance(v, (int, float)): return float(v)
+    try:
+        return float(str(v).strip().replace(',', '.'))
+    except ValueError:
+        return np.nan
+
+
+def section_of(row):
+    # Section header rows have text in col 0 and nothing in col 1
+    if is_empty(row[0]) or not is_empty(row[1]) or not isinstance(row[0], str):
+        return None
+    m = _SECTION_RE.match(row[0])
+    if m:
+        return SECTIONS[m.group(1)]
+    text = _fold(row[0])
+    for keyword, kind in SECTION_KEYWORDS:
+        if keyword in text:
+            return kind
+    return None
+
+
+PRODUCTION_LABEL = "PRODUCAO DA EQUIPE"
+
+
+def production_of(block):
+    # "Produção da equipe" label (usually on the header row) and the first figure
+    # to its right on that same row. Other cells that merely mention "produção"
+    # / "produto" (descriptions, insumos) are not production figures.
+    for row in [block["header"]] + block["rows"]:
+        for i, v in enumerate(row):
+            if isinstance(v, str) and _fold(v).strip().startswith(PRODUCTION_LABEL):
+                for w in row[i + 1:]:
+                    p = _num(w)
+                    if not np.isnan(p):
+                        return p
+                print(f"SICRO {block['code']}: '{v}' without a figure next to it")
+                return np.nan
+    print(f"SICRO {block['code']}: no 'Produção da equipe' found, priced as hourly = unit")
+    return np.nan
+
+
+def price_sicro_blocks(blocks):
+    """Price SICRO compositions. Returns (prices, items).
+
+    prices: one row per composition with code, desc, production, hourly
+            EQP/MO costs, per-group unit costs (price_mat/mo/eqp/out) and price.
+    items:  the composition rows ready for tabela_insumos_export, with the
+            coefficient of EQP/MO rows already divided by the production so
+            that sum(coef * price) gives the composition price.
+    """
+    codes, descs, prods = [], [], []
+    r_block, r_kind, r_code, r_desc, r_unit = [], [], [], [], []
+    r_vals = []  # qty, util op, util improd, custo op, custo improd, price
+
+    for b, block in enumerate(blocks):
+        codes.append(block["code"])
+        descs.append(block["desc"])
+        prods.append(production_of(block))
+        kind = None
+        for row in block["rows"]:
+            s = section_of(row)
+            if s:
+                kind = s
+                continue
+            if not is_item_row(row):
+                continue
+            r_block.append(b)
+            r_kind.append(kind or "MAT")
+            r_code.append(normalize_val(row[0]))
+            r_desc.append(row[1])
+            r_unit.append("H" if kind in ("EQP", "MO") else (row[4] if not is_empty(row[4]) else row[UNIT_COL]))
+            r_vals.append([_num(row[c]) for c in EQP_COLS] + [_num(row[PRICE_COL])])
+
+    n = len(codes)
+    prod = np.array(prods, dtype=float)
+    # Without a production figure the composition is not "por produção": hourly = unit
+    prod_div = np.where(np.isnan(prod) | (prod <= 0), 1.0, prod)
+
+    if r_block:
+        vals = np.nan_to_num(np.array(r_vals, dtype=float))
+        block_idx = np.array(r_block, dtype=np.int64)
+        kinds = np.array(r_kind)
+        qty, u_op, u_imp, c_op, c_imp, price = vals.T
+        is_eqp = kinds == "EQP"
+        # Equipment: productive and unproductive hours priced on the same row
+        row_price = np.where(is_eqp, u_op * c_op + u_imp * c_imp, price)
+        row_cost = qty * row_price
+    else:
+        block_idx = np.zeros(0, dtype=np.int64)
+        kinds = np.array([], dtype=str)
+        qty = row_price = row_cost = np.zeros(0)
+
+    def per_block(mask):
+        return np.bincount(block_idx[mask], weights=row_cost[mask], minlength=n)
+
+    eqp_hour = per_block(kinds == "EQP")
+    mo_hour = per_block(kinds == "MO")
+    mat = per_block(kinds == "MAT")
+    out = per_block(np.isin(kinds, ["AUX", "TEMPO_FIXO", "TRANSPORTE"]))
+
+    prices = pd.DataFrame({
+        "code": codes,
+        "desc": descs,
+        "production": prod,
+        "eqp_hourly": eqp_hour,
+        "mo_hourly": mo_hour,
+        "price_mat": mat,
+        "price_mo": mo_hour / prod_div,
+        "price_eqp": eqp_hour / prod_div,
+        "price_out": out,
+    })
+    prices["price"] = prices["price_mat"] + prices["price_mo"] + prices["price_eqp"] + prices["price_out"]
+
+    per_hour = np.isin(kinds, ["EQP", "MO"])
+    coef = np.where(per_hour, qty / prod_div[block_idx], qty) if len(block_idx) else qty
+    items = pd.DataFrame({
+        "parent_code": [codes[b] for b in r_block],
+        "src": "SICRO",
+        "res_code": r_code,
+        "res_desc": r_desc,
+        "res_unit": r_unit,
+        "coef": coef,
+        "price": row_price,
+    })
+    return prices, items
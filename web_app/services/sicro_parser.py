@@ -0,0 +1,63 @@
+from openpyxl import load_workbook
+
+# The SICRO "Relatório Analítico de Composições de Custos" has ~200k rows.
+# Instead of materialising it as a DataFrame we stream it with openpyxl in
+# read-only mode and hand out one composition block at a time.
+
+MIN_COLS = 8
+
+
+def normalize_val(v):
+    if v is None: return None
+    s = str(v).strip().upper()
+    if s.endswith('.0'): s = s[:-2]
+    return s or None
+
+
+def is_empty(v):
+    return v is None or (isinstance(v, str) and v.strip() == "")
+
+
+def is_header_row(row):
+    # Composition header: code in col 0, description in col 1, col 3 empty.
+    return bool(normalize_val(row[0])) and not is_empty(row[1]) and is_empty(row[3])
+
+
+def is_item_row(row):
+    return not is_empty(row[1]) and not is_empty(row[3])
+
+
+def iter_sicro_blocks(path, required_codes=None):
+    """Yield one dict per composition: code, desc, header row and the raw rows below it.
+
+    Compositions not in required_codes (when given) are skipped while reading,
+    so their rows are never kept in memory.
+    """
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        block = None
+        current = None
+        for row in ws.iter_rows(values_only=True):
+            if len(row) < MIN_COLS:
+                row = tuple(row) + (None,) * (MIN_COLS - len(row))
+
+            if is_header_row(row):
+                code = normalize_val(row[0])
+                if code == current:
+                    continue  # Header repeated (page break) inside the same block
+                if block is not None:
+                    yield block
+                current = code
+                block = None
+                if required_codes is None or code in required_codes:
+                    block = {"code": code, "desc": row[1], "header": row, "rows": []}
+                continue
+
+            if block is not None:
+                block["rows"].append(row)
+
+        if block is not None:
+            yield block
+    finally:
+        wb.close()
@@ -0,0 +1,145 @@
+import os
+import threading
+import traceback
+from pathlib import Path
+
+from .data_loader import OrcamentoService
+from .workbook_cache import file_fingerprint
+
+# Hot reload of the web service. The loaded OrcamentoService is an immutable
+# snapshot from the readers' point of view: a reload builds a brand new one
+# on a background thread and only then replaces the reference, so a request
+# holding the old snapshot finishes on consistent data and nobody ever sees a
+# half-built one. While a reload runs the previous snapshot keeps serving.
+# A price change (update_price) follows the same rule: it is made on a copy
+# of the current snapshot, which is then swapped in. Such changes are dropped
+# by the next reload, which reads the workbooks again.
+
+WATCH_ENV = "ORCAMENTO_WATCH" # "1": reload when an input workbook changes
+WATCH_INTERVAL = 2.0 # seconds between polls of the watched files
+
+
+class ServiceSnapshots:
+    def __init__(self, factory=OrcamentoService):
+        self.factory = factory
+        self.current = None # OrcamentoService being served
+        self.loading = None # OrcamentoService being built
+        self.generation = 0 # how many snapshots have been swapped in
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def reload(self, reason="manual"):
+        """Build a new snapshot in the background. False if one is already being built."""
+        with self._lock:
+            if self.loading is not None:
+                return False
+            self.loading = self.factory()
+        threading.Thread(target=self._build, args=(self.loading, reason), name="orcamento-reload", daemon=True).start()
+        return True
+
+    def _build(self, svc, reason):
+        print(f"Building service snapshot ({reason})...")
+        try:
+            svc.load_and_calculate()
+            if self.current is not None:
+                # Missing / unreadable workbook (e.g. caught mid-save): keep serving the previous data
+                if not svc.po_items:
+                    raise RuntimeError(f"No PO items read from {svc.po_file}; keeping the current snapshot")
+                if not svc.sinapi_prices or not svc.comp_map:
+                    raise RuntimeError(f"No SINAPI prices/compositions read from {svc.sinapi_file}; keeping the current snapshot")
+        except Exception as e:
+            traceback.print_exc()
+            self.last_error = str(e)
+        else:
+            with self._lock:
+                self.current = svc # single reference assignment: the swap
+                self.generation += 1
+                self.last_error = None
+            print(f"Snapshot {self.generation} in service.")
+        finally:
+            with self._lock:
+                self.loading = None
+
+    def update_price(self, code, new_price):
+        """OrcamentoService.update_price on a copy of the current snapshot, then swapped in."""
+        with self._lock:
+            svc = self.current.copy()
+            result = svc.update_price(code, new_price)
+            self.current = svc
+        return result
+
+    def status(self):
+        # State of the served snapshot, plus the reload in progress if any
+        loading = self.loading
+        if self.current is not None:
+            st = self.current.get_status()
+        elif loading is not None:
+            st = loading.get_status()
+        else:
+            st = {"state": "error" if self.last_error else "idle", "stage": None, "elapsed": None,
+                  "error": self.last_error, "items": None}
+        st["generation"] = self.generation
+        st["reloading"] = loading is not None and self.current is not None
+        st["reload"] = loading.get_status() if st["reloading"] else None
+        st["last_error"] = self.last_error
+        return st
+
+
+class FileWatcher:
+    """Polls (size, mtime) of some files and calls on_change(names) once they changed and settled."""
+
+    def __init__(self, paths, on_change, interval=WATCH_INTERVAL):
+        self.paths = [Path(p) for p in paths]
+        self.on_change = on_change
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def snapshot(self):
+        return {p: self._fingerprint(p) for p in self.paths}
+
+    @staticmethod
+    def _fingerprint(path):
+        # None while the file is missing (Excel saves to a temp file and renames it over)
+        try:
+            return file_fingerprint(path)
+        except OSError:
+            return None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="orcamento-watch", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        seen = self.snapshot()
+        pending = None # fingerprints of a change waiting to settle
+        while not self._stop.wait(self.interval):
+            try:
+                now = self.snapshot()
+            except Exception:
+                traceback.print_exc() # never let the watcher die silently
+                continue
+            if now == seen:
+                pending = None
+                continue
+            if now != pending:
+                # Still being written (Excel saves in several steps): wait one more poll
+                pending = now
+                continue
+            changed = [p.name for p in self.paths if now[p] != seen[p]]
+            pending = None
+            # on_change -> False (a reload was already running): retried on the next polls
+            if self.on_change(changed) is not False:
+                seen = now
+
+
+def watch_enabled():
+    return os.environ.get(WATCH_ENV) == "1"
+
+
+def watched_files(svc):
+    # Workbooks OrcamentoService reads
+    return [svc.po_file, svc.sinapi_file]
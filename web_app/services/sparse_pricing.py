@@ -0,0 +1,104 @@
+import numpy as np
+
+
+class SparseCostModel:
+    """comp_map encoded as a sparse coefficient matrix A so that p = b + A·p.
+
+    b holds the loaded prices (ISD/CSD), A[parent, child] the Analítico
+    coefficients. Because the graph is a DAG, rows are grouped by depth
+    (level 1 = only depends on loaded prices, level 2 = depends on level 1...)
+    and each level is solved with one gather + one scatter-add, i.e. a
+    block-triangular solve in topological order. A full recalculation is a
+    handful of array operations and a what-if only needs a new b.
+
+    Built from a PricingEngine so both share the same order and leaves.
+    """
+
+    def __init__(self, engine):
+        comp_map = engine.comp_map
+        codes = list(comp_map)
+        seen = set(codes)
+        for children in comp_map.values():
+            for child in children:
+                if child['code'] not in seen:
+                    seen.add(child['code'])
+                    codes.append(child['code'])
+        self.codes = codes
+        self.index = {code: i for i, code in enumerate(codes)}
+        self.computed = np.array([self.index[c] for c in engine.order], dtype=np.int64)
+
+        level = {}
+        for parent in engine.order:
+            lv = 0
+            for child in comp_map[parent]:
+                lv = max(lv, level.get(child['code'], 0))
+            level[parent] = lv + 1
+
+        by_level = {}
+        for parent in engine.order:
+            by_level.setdefault(level[parent], []).append(parent)
+
+        # One COO block per level: local row (position in targets), column, coefficient
+        self.levels = []
+        for lv in sorted(by_level):
+            parents = by_level[lv]
+            rows, cols, coefs = [], [], []
+            for r, parent in enumerate(parents):
+                for child in comp_map[parent]:
+                    rows.append(r)
+                    cols.append(self.index[child['code']])
+                    coefs.append(child['coef'])
+            self.levels.append((
+                np.array([self.index[p] for p in parents], dtype=np.int64),
+                np.array(rows, dtype=np.int64),
+                np.array(cols, dtype=np.int64),
+                np.array(coefs, dtype=float),
+            ))
+
+    def price_vector(self, prices):
+        x = np.zeros(len(self.codes))
+        for code, i in self.index.items():
+            p = prices.get(code)
+            if p is not None:
+                x[i] = p
+        return x
+
+    def solve(self, x, pinned=None):
+        """Overwrite every computed composition in x (1-D prices or 2-D n×k columns).
+
+        pinned: optional bool mask over codes; those compositions keep their value in x.
+        """
+        for targets, rows, cols, coefs in self.levels:
+            if x.ndim == 1:
+                out = np.bincount(rows, weights=coefs * x[cols], minlength=len(targets))
+            else:
+                out = np.zeros((len(targets), x.shape[1]))
+                np.add.at(out, rows, coefs[:, None] * x[cols])
+            if pinned is not None:
+                keep = ~pinned[targets]
+                targets, out = targets[keep], out[keep]
+            x[targets] = out
+        return x
+
+    def calculate(self, prices):
+        """Same contract as PricingEngine.calculate, done with array operations."""
+        x = self.solve(self.price_vector(prices))
+        for i in self.computed:
+            prices[self.codes[i]] = float(x[i])
+        return prices
+
+    def what_if(self, base_vector, overrides):
+        """Reprice every composition with some prices replaced; returns code -> price.
+
+        An override on a computed composition pins it: it keeps the given price
+        and its parents are priced from it (like update_price does).
+        """
+        x = base_vector.copy()
+        pinned = np.zeros(len(self.codes), dtype=bool)
+        for code, price in overrides.items():
+            i = self.index.get(code)
+            if i is not None:
+                x[i] = price
+                pinned[i] = True
+        self.solve(x, pinned if pinned[self.computed].any() else None)
+        return {self.codes[i]: float(x[i]) for i in self.computed}
@@ -0,0 +1,176 @@
+import re
+import unicodedata
+from collections import defaultdict
+
+import numpy as np
+
+# Words that carry no meaning in SINAPI / SICRO / CDHU descriptions
+STOPWORDS = frozenset("""
+A AO AOS AS COM DA DAS DE DO DOS E EM NA NAS NO NOS O OS OU PARA PELA PELO POR SEM UM UMA
+""".split())
+
+_NON_WORD = re.compile(r"[^0-9A-Z]+")
+
+
+def fold_text(text):
+    # Upper case, accents stripped, punctuation -> space ("Concreto fck=25MPa" -> "CONCRETO FCK 25MPA")
+    if text is None or (isinstance(text, float) and np.isnan(text)):
+        return ""
+    s = unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode().upper()
+    return _NON_WORD.sub(" ", s).strip()
+
+
+def tokenize(text):
+    return [t for t in fold_text(text).split() if len(t) > 1 and t not in STOPWORDS]
+
+
+class TokenIndex:
+    """Inverted index of TF-IDF weighted tokens over a list of descriptions.
+
+    Every document vector is L2 normalised, and so is every query vector, over
+    all of its tokens: a token no document has gets the highest idf, so it
+    weighs on the norm and a query that is mostly unknown words scores low.
+    The score of a query is then its cosine similarity with each document.
+
+    The documents are kept as a sparse token x document matrix in CSR form
+    (indptr / docs / weights, i.e. the posting list of every token). search()
+    builds the sparse matrix of all its queries and multiplies it with that
+    one in a single pass: the postings of every (query, token) entry are
+    gathered at once and the products summed per (query, document).
+    """
+
+    def __init__(self, texts):
+        self.n_docs = len(texts)
+        counts = []
+        df = defaultdict(int)
+        for text in texts:
+            tf = defaultdict(int)
+            for tok in tokenize(text):
+                tf[tok] += 1
+            counts.append(tf)
+            for tok in tf:
+                df[tok] += 1
+
+        self.vocab = {tok: i for i, tok in enumerate(df)}
+        self.idf = np.array([np.log((1 + self.n_docs) / (1 + n)) + 1.0 for n in df.values()], dtype=float)
+        # idf of a token no document has (df = 0)
+        self.unseen_idf = np.log(1 + self.n_docs) + 1.0
+
+        tok_ids, doc_ids, weights = [], [], []
+        for doc, tf in enumerate(counts):
+            ids = np.array([self.vocab[t] for t in tf], dtype=np.int64)
+            w = np.array(list(tf.values()), dtype=float) * self.idf[ids]
+            norm = np.sqrt((w * w).sum()) or 1.0
+            tok_ids.append(ids)
+            doc_ids.append(np.full(len(ids), doc, dtype=np.int64))
+            weights.append(w / norm)
+        tok_ids = np.concatenate(tok_ids) if tok_ids else np.zeros(0, dtype=np.int64)
+        doc_ids = np.concatenate(doc_ids) if doc_ids else np.zeros(0, dtype=np.int64)
+        weights = np.concatenate(weights) if weights else np.zeros(0)
+        # CSR, one row per token: row t is docs[indptr[t]:indptr[t + 1]]
+        order = np.argsort(tok_ids, kind="stable")
+        self.docs = doc_ids[order]
+        self.weights = weights[order]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(tok_ids, minlength=len(self.vocab)))]).astype(np.int64)
+
+    def query_matrix(self, texts):
+        """Sparse matrix of the queries as (row, token id, weight) arrays."""
+        rows, ids, weights = [], [], []
+        for row, text in enumerate(texts):
+            tf = defaultdict(int)
+            for tok in tokenize(text):
+                tf[tok] += 1
+            if not tf:
+                continue
+            w = np.array([n * (self.idf[self.vocab[t]] if t in self.vocab else self.unseen_idf)
+                          for t, n in tf.items()])
+            w /= np.sqrt((w * w).sum())
+            for (tok, _), v in zip(tf.items(), w):
+                if tok in self.vocab: # unknown tokens only count in the norm
+                    rows.append(row)
+                    ids.append(self.vocab[tok])
+                    weights.append(v)
+        return np.array(rows, dtype=np.int64), np.array(ids, dtype=np.int64), np.array(weights, dtype=float)
+
+    def score_matrix(self, texts):
+        """Queries x documents product: (query, doc, score) arrays of the non-zero scores."""
+        q_rows, q_ids, q_w = self.query_matrix(texts)
+        starts = self.indptr[q_ids]
+        lens = self.indptr[q_ids + 1] - starts
+        # Every posting of every (query, token) entry, gathered in one go
+        pos = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+        keys = np.repeat(q_rows, lens) * self.n_docs + self.docs[pos]
+        vals = np.repeat(q_w, lens) * self.weights[pos]
+        keys, inverse = np.unique(keys, return_inverse=True)
+        scores = np.bincount(inverse, weights=vals, minlength=len(keys))
+        return keys // max(self.n_docs, 1), keys % max(self.n_docs, 1), scores
+
+    def scores(self, text):
+        """Cosine similarity of text with every document (dense array)."""
+        _, docs, scores = self.score_matrix([text])
+        out = np.zeros(self.n_docs)
+        out[docs] = scores
+        return out
+
+    def search(self, texts, k=3, min_score=0.0):
+        """For each text, [(doc, score)] of its k best documents, best first."""
+        q, docs, scores = self.score_matrix(texts)
+        keep = (scores > 0) & (scores >= min_score)
+        q, docs, scores = q[keep], docs[keep], scores[keep]
+        # Per query, best score first (ties: lowest doc first), then the first k
+        order = np.lexsort((docs, -scores, q))
+        q, docs, scores = q[order], docs[order], scores[order]
+        first = np.searchsorted(q, q) # start of each query's run
+        keep = np.arange(len(q)) - first < k
+        out = [[] for _ in texts]
+        for row, doc, score in zip(q[keep], docs[keep], scores[keep]):
+            out[row].append((int(doc), float(score)))
+        return out
+
+    def top_k(self, text, k=3, min_score=0.0):
+        """[(doc, score)] of the k best documents, best first."""
+        return self.search([text], k, min_score)[0]
+
+
+def fold_case(text):
+    # Upper case and accents stripped, punctuation kept (codes like 02.02.130 stay searchable)
+    if text is None or (isinstance(text, float) and np.isnan(text)):
+        return ""
+    return unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode().upper()
+
+
+class NgramIndex:
+    """Substring search over one text column via an n-gram index.
+
+    The column is folded once (fold_case). A query of n or more characters
+    intersects the posting lists of its n-grams and only checks the
+    surviving rows; shorter queries scan the folded cache.
+    """
+
+    def __init__(self, texts, n=3):
+        self.n = n
+        self.texts = [fold_case(t) for t in texts]
+        postings = defaultdict(list)
+        for row, text in enumerate(self.texts):
+            for gram in {text[i:i + n] for i in range(len(text) - n + 1)}:
+                postings[gram].append(row)
+        self.postings = {g: np.array(rows, dtype=np.int64) for g, rows in postings.items()}
+
+    def search(self, query):
+        """Sorted row numbers whose text contains query (case/accent insensitive)."""
+        q = fold_case(query).strip()
+        if not q:
+            return np.arange(len(self.texts))
+        if len(q) < self.n:
+            return np.array([r for r, t in enumerate(self.texts) if q in t], dtype=np.int64)
+        grams = {q[i:i + self.n] for i in range(len(q) - self.n + 1)}
+        lists = [self.postings.get(g) for g in grams]
+        if any(p is None for p in lists):
+            return np.zeros(0, dtype=np.int64)
+        lists.sort(key=len)
+        rows = lists[0]
+        for p in lists[1:]:
+            rows = np.intersect1d(rows, p, assume_unique=True)
+            if not len(rows):
+                break
+        return np.array([r for r in rows if q in self.texts[r]], dtype=np.int64)
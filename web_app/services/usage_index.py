@@ -0,0 +1,117 @@
+from collections import defaultdict
+
+
+class UsageIndex:
+    """"Insumo -> onde é usado" for the loaded budget.
+
+    used_in is the reverse of comp_map with the coefficients kept
+    (child -> [(parent, coef)]). demand is the quantity of every code the
+    whole obra consumes: each PO item puts its qty on its own code, and the
+    calculated compositions push it down to their children in reverse
+    topological order (PO qty x chained coefficients). Quantities do not
+    depend on prices, so both are built once per load; R$ figures are taken
+    from the current prices when asked.
+    """
+
+    def __init__(self, engine, po_items):
+        self.engine = engine
+        self.used_in = defaultdict(list)
+        self.descs = {}
+        self.units = {}
+        for parent, children in engine.comp_map.items():
+            for child in children:
+                self.used_in[child['code']].append((parent, child['coef']))
+                self.descs.setdefault(child['code'], child['desc'])
+                self.units.setdefault(child['code'], child['unit'])
+
+        self.po_items = [i for i in po_items if i['type'] != 'HEADER' and i['code']]
+        for item in self.po_items:
+            self.descs.setdefault(item['code'], item['desc'])
+            self.units.setdefault(item['code'], item['unit'])
+
+        self.demand = defaultdict(float)
+        for item in self.po_items:
+            self.demand[item['code']] += item['qty']
+        for parent in reversed(engine.order):
+            q = self.demand.get(parent, 0.0)
+            if not q:
+                continue
+            for child in engine.comp_map[parent]:
+                self.demand[child['code']] += q * child['coef']
+
+        self._per_unit = {}   # code -> {po code: qty of code per unit of po code}
+        self._ranking = None  # [(impact, code)] over leaves, highest first
+        self._rank = {}       # code -> position in _ranking (1 = biggest impact)
+        self._total_impact = 0.0
+
+    def is_insumo(self, code):
+        # Priced as a leaf (ISD/CSD price or plain child), not calculated
+        return code not in self.engine.position
+
+    def per_unit(self, code):
+        """How much of code one unit of each (calculated) ancestor consumes."""
+        if code not in self._per_unit:
+            up = self.engine.ancestors(code)
+            q = {code: 1.0}
+            for parent in sorted(up, key=self.engine.position.__getitem__):
+                total = 0.0
+                for child in self.engine.comp_map[parent]:
+                    total += q.get(child['code'], 0.0) * child['coef']
+                q[parent] = total
+            self._per_unit[code] = q
+        return self._per_unit[code]
+
+    def ranking(self, prices):
+        if self._ranking is None:
+            self._ranking = sorted(
+                ((q * prices.get(c, 0.0), c) for c, q in self.demand.items() if self.is_insumo(c)),
+                reverse=True)
+            self._rank = {c: n for n, (_, c) in enumerate(self._ranking, 1)}
+            self._total_impact = sum(i for i, _ in self._ranking)
+        return self._ranking
+
+    def invalidate_prices(self):
+        self._ranking = None
+
+    def usage(self, code, prices):
+        price = prices.get(code, 0.0)
+        per_unit = self.per_unit(code)
+
+        items = []
+        for item in self.po_items:
+            k = per_unit.get(item['code'])
+            if not k:
+                continue
+            consumption = item['qty'] * k
+            items.append({
+                "idx": item['idx'],
+                "code": item['code'],
+                "desc": item['desc'],
+                "qty": item['qty'],
+                "per_unit": k,
+                "consumption": consumption,
+                "impact": consumption * price,
+            })
+        items.sort(key=lambda i: i['impact'], reverse=True)
+
+        ranking = self.ranking(prices)
+        total_impact = self._total_impact
+        consumption = self.demand.get(code, 0.0)
+
+        return {
+            "code": code,
+            "desc": self.descs.get(code),
+            "unit": self.units.get(code),
+            "unit_price": price,
+            "used_in": [
+                {"code": p, "desc": self.descs.get(p), "coef": coef, "calculated": p in self.engine.position}
+                for p, coef in self.used_in.get(code, ())
+            ],
+            "compositions": len(per_unit) - 1,
+            "po_items": items,
+            "total_consumption": consumption,
+            "total_impact": consumption * price,
+            "impact_share": consumption * price / total_impact if total_impact else 0.0,
+            "rank": self._rank.get(code),
+            "insumos_ranked": len(ranking),
+        }
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+# Parsed sheets are kept here as binary snapshots so an unchanged reference
+# workbook (SINAPI, CDHU, PO) never goes through openpyxl again.
+# Snapshots are pandas pickles: header=None sheets mix numbers and text in the
+# same column, which Parquet/Feather would coerce away.
+CACHE_DIR = Path("dados/cache")
+
+_hash_memo = {}  # (path, size, mtime_ns) -> sha256, so the 3 SINAPI sheets hash the file once
+
+
+def file_fingerprint(path):
+    st = Path(path).stat()
+    return st.st_size, st.st_mtime_ns
+
+
+def content_hash(path):
+    path = Path(path)
+    size, mtime_ns = file_fingerprint(path)
+    memo_key = (str(path.resolve()), size, mtime_ns)
+    if memo_key in _hash_memo:
+        return _hash_memo[memo_key]
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _hash_memo[memo_key] = digest
+    return digest
+
+
+def _snapshot_paths(path, sheet_name, read_kwargs, cache_dir):
+    # One snapshot per (file, sheet, read options): ISD with skiprows=10 and
+    # Analítico with skiprows=5 must never share an entry.
+    key_src = json.dumps({
+        "file": Path(path).resolve().as_posix(),
+        "sheet": sheet_name,
+        "kwargs": read_kwargs,
+    }, sort_keys=True, default=str)
+    key = hashlib.sha1(key_src.encode("utf-8")).hexdigest()[:16]
+    name = f"{Path(path).stem}.{key}"
+    return Path(cache_dir) / f"{name}.pkl", Path(cache_dir) / f"{name}.json"
+
+
+def _is_fresh(path, meta_file):
+    if not meta_file.exists():
+        return False
+    try:
+        meta = json.loads(meta_file.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return False
+
+    size, mtime_ns = file_fingerprint(path)
+    if meta.get("size") == size and meta.get("mtime_ns") == mtime_ns:
+        return True
+
+    # Touched (copied, re-saved by another tool...) but maybe not changed:
+    # only the content hash decides.
+    if meta.get("size") == size and meta.get("sha256") == content_hash(path):
+        meta["mtime_ns"] = mtime_ns
+        meta_file.write_text(json.dumps(meta), encoding="utf-8")
+        return True
+    return False
+
+
+def read_excel_cached(path, sheet_name=0, cache_dir=CACHE_DIR, **read_kwargs):
+    """Drop-in for pd.read_excel that reuses a snapshot while the workbook is unchanged."""
+    snap_file, meta_file = _snapshot_paths(path, sheet_name, read_kwargs, cache_dir)
+
+    if snap_file.exists() and _is_fresh(path, meta_file):
+        try:
+            return pd.read_pickle(snap_file)
+        except Exception as e:
+            print(f"Cache snapshot unreadable ({snap_file.name}): {e}. Re-parsing.")
+
+    df = pd.read_excel(path, sheet_name=sheet_name, **read_kwargs)
+
+    try:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        size, mtime_ns = file_fingerprint(path)
+        tmp = snap_file.with_name(snap_file.name + ".tmp")
+        df.to_pickle(tmp)
+        os.replace(tmp, snap_file)
+        meta_file.write_text(json.dumps({
+            "source": Path(path).name,
+            "sheet": sheet_name,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "sha256": content_hash(path),
+        }), encoding="utf-8")
+    except Exception as e:
+        print(f"Could not write cache snapshot for {Path(path).name}/{sheet_name}: {e}")
+
+    return df